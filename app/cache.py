@@ -0,0 +1,80 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable
+
+from fastapi_mqtt.fastmqtt import FastMQTT
+
+_LOGGER = logging.getLogger(__name__)
+
+# Returned by TTLCache.get for keys that are not cached
+MISSING = object()
+
+# Server processes sharing a broker tell each other which cached entries to drop
+INVALIDATE_TOPIC = "moca/invalidate/#"
+
+
+class TTLCache:
+    """Least recently used cache whose entries expire after `ttl` seconds.
+    None is a valid value, so lookups that found nothing can be cached too."""
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # key -> (expiry time, value), least recently used first
+        self.entries: OrderedDict = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Any:
+        """Get the value for the key, or MISSING."""
+
+        entry = self.entries.get(key)
+
+        if entry is None or entry[0] < time.monotonic():
+            self.entries.pop(key, None)
+            self.misses += 1
+            return MISSING
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self.entries.pop(key, None)
+
+    def invalidate_where(self, predicate: Callable[[Hashable, Any], bool]):
+        """Remove all entries for which predicate(key, value) is true."""
+
+        keys = [
+            key for key, (_, value) in self.entries.items() if predicate(key, value)
+        ]
+
+        for key in keys:
+            del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+async def publish_invalidation(mqtt: FastMQTT, topic: str):
+    """Tell all server processes to drop the cached entries the topic is about.
+    If publishing fails, the other processes keep them until they expire."""
+
+    try:
+        await mqtt.publish(topic, json.dumps({}))
+    except Exception:
+        _LOGGER.warning(f"Could not publish invalidation on {topic}.", exc_info=True)
@@ -1,32 +1,52 @@
 import json
 import random
 from datetime import datetime
-from typing import List
+from typing import Dict, Iterable, List, Optional
 from fastapi.exceptions import HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import bindparam, delete, func, insert, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
 from fastapi import status
 from sqlalchemy.sql.operators import desc_op
-from . import models, schemas
-from .dependencies import get_hashed_password
+from . import dependencies, models, schemas
+from .cache import MISSING, TTLCache, publish_invalidation
+from .ids import stable_id
 import logging
 
 _LOGGER = logging.getLogger(__name__)
 
+# (connector id, internal contact id) -> contact id, or None if there is no such contact
+contact_id_cache = TTLCache(max_size=100000, ttl=600)
 
-def get_user(db: Session, user_id: int):
-    return db.query(models.User).filter(models.User.user_id == user_id).first()
+# connector id -> column values of the connector, or None if there is no such connector
+connector_cache = TTLCache(max_size=10000, ttl=60)
 
+# PostgreSQL advisory lock that serializes writes to the change log
+CHANGES_LOCK = 0x6D6F6361
 
-def get_user_by_username(db: Session, username: str) -> models.User:
-    return db.query(models.User).filter(models.User.username == username).first()
 
+async def get_user(db: AsyncSession, user_id: int):
+    result = await db.execute(
+        select(models.User).filter(models.User.user_id == user_id)
+    )
+    return result.scalars().first()
+
+
+async def get_user_by_username(db: AsyncSession, username: str) -> models.User:
+    result = await db.execute(
+        select(models.User).filter(models.User.username == username)
+    )
+    return result.scalars().first()
 
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.User).offset(skip).limit(limit).all()
 
+async def get_users(db: AsyncSession, skip: int = 0, limit: int = 100):
+    result = await db.execute(select(models.User).offset(skip).limit(limit))
+    return result.scalars().all()
 
-def create_user(db: Session, user: schemas.RegisterRequest):
-    hashed_password = get_hashed_password(user.password)
+
+async def create_user(db: AsyncSession, user: schemas.RegisterRequest):
+    hashed_password = await dependencies.get_hashed_password(user.password)
 
     verification_code = "{:06d}".format(random.randint(0, 999999))
 
@@ -41,14 +61,14 @@ def create_user(db: Session, user: schemas.RegisterRequest):
         created_at=datetime.now(),
     )
     db.add(db_user)  # add is ok here
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
 
     return db_user
 
 
-def verify_user(db: Session, request: schemas.VerifyRequest):
-    user = get_user_by_username(db, request.username)
+async def verify_user(db: AsyncSession, request: schemas.VerifyRequest):
+    user = await get_user_by_username(db, request.username)
 
     if not user:
         raise HTTPException(
@@ -62,77 +82,143 @@ def verify_user(db: Session, request: schemas.VerifyRequest):
         )
 
     user.is_verified = True
-    db.commit()
+    await db.commit()
 
     return user
 
 
-def get_chats_for_user(db: Session, user_id: int) -> List[models.Chat]:
-    return (
-        db.query(models.Chat)
+async def get_chats_for_user(db: AsyncSession, user_id: int) -> List[models.Chat]:
+    result = await db.execute(
+        select(models.Chat)
         .join(models.Connector)
         .filter(models.Connector.user_id == user_id)
-        .all()
     )
+    return result.scalars().all()
 
 
-def get_contacts_for_user(db: Session, user_id: int) -> List[models.Contact]:
-    contacts = (
-        db.query(models.Contact)
+async def get_contacts_for_user(db: AsyncSession, user_id: int) -> List[models.Contact]:
+    result = await db.execute(
+        select(models.Contact)
         .join(models.Connector)
         .filter(
             models.Connector.user_id == user_id,
             models.Contact.connector_id == models.Connector.connector_id,
         )
-        .all()
     )
-    return contacts
+    return result.scalars().all()
 
 
-def get_contact(db: Session, user_id: int, contact_id: int) -> models.Contact:
-    return (
-        db.query(models.Contact)
+async def get_contact(
+    db: AsyncSession, user_id: int, contact_id: int
+) -> models.Contact:
+    result = await db.execute(
+        select(models.Contact)
         .join(models.Connector)
         .filter(
             models.Connector.user_id == user_id,
             models.Contact.connector_id == models.Connector.connector_id,
             models.Contact.contact_id == contact_id,
         )
-        .first()
     )
+    return result.scalars().first()
 
 
-def get_contact_from_connector(
-    db: Session, user_id: int, connector_id: int, internal_contact_id: str
+async def get_contact_from_connector(
+    db: AsyncSession, user_id: int, connector_id: int, internal_contact_id: str
 ) -> models.Contact:
-    return (
-        db.query(models.Contact)
+    result = await db.execute(
+        select(models.Contact)
         .join(models.Connector)
         .filter(
             models.Connector.user_id == user_id,
             models.Connector.connector_id == connector_id,
             models.Contact.internal_id == internal_contact_id,
         )
-        .first()
     )
+    return result.scalars().first()
 
 
-def get_chat(db: Session, user_id: int, chat_id: int) -> models.Chat:
-    return (
-        db.query(models.Chat)
+async def get_self_contact(db: AsyncSession, connector_id: int) -> models.Contact:
+    result = await db.execute(
+        select(models.Contact).filter(
+            models.Contact.connector_id == connector_id, models.Contact.is_self
+        )
+    )
+    return result.scalars().first()
+
+
+async def get_contact_ids_from_connector(
+    db: AsyncSession, connector_id: int, internal_contact_ids: List[str]
+) -> Dict[str, int]:
+    """Get the contact ids of existing contacts by their (string) internal ids.
+    Results (including contacts that do not exist) are cached."""
+
+    contact_ids = {}
+    uncached = []
+
+    for internal_id in internal_contact_ids:
+        contact_id = contact_id_cache.get((connector_id, internal_id))
+
+        if contact_id is MISSING:
+            uncached.append(internal_id)
+        elif contact_id is not None:
+            contact_ids[internal_id] = contact_id
+
+    # Stay below the maximum number of query parameters
+    for i in range(0, len(uncached), 500):
+        result = await db.execute(
+            select(models.Contact.internal_id, models.Contact.contact_id).filter(
+                models.Contact.connector_id == connector_id,
+                models.Contact.internal_id.in_(uncached[i : i + 500]),
+            )
+        )
+        contact_ids.update(
+            (str(internal_id), contact_id) for internal_id, contact_id in result
+        )
+
+    for internal_id in uncached:
+        contact_id_cache.set((connector_id, internal_id), contact_ids.get(internal_id))
+
+    return contact_ids
+
+
+def cache_contact_ids(connector_id: int, contact_ids: Dict[str, int]):
+    """Remember contact ids by their (string) internal ids, after the contacts were written."""
+
+    for internal_id, contact_id in contact_ids.items():
+        contact_id_cache.set((connector_id, str(internal_id)), contact_id)
+
+
+async def invalidate_connector_contacts(connector_id: int):
+    """Forget the cached contact ids of a connector in all server processes,
+    e.g. after it was deleted."""
+
+    drop_connector_contacts(connector_id)
+    await publish_invalidation(
+        dependencies.mqtt, f"moca/invalidate/contacts/{connector_id}"
+    )
+
+
+def drop_connector_contacts(connector_id: int):
+    contact_id_cache.invalidate_where(lambda key, _: key[0] == connector_id)
+
+
+async def get_chat(db: AsyncSession, user_id: int, chat_id: int) -> models.Chat:
+    result = await db.execute(
+        select(models.Chat)
         .join(models.Connector)
         .filter(models.Connector.user_id == user_id, models.Chat.chat_id == chat_id)
-        .first()
     )
+    return result.scalars().first()
 
 
-def get_last_message(db: Session, user_id: int, chat_id: int):
-    model = (
-        db.query(models.Message)
+async def get_last_message(db: AsyncSession, user_id: int, chat_id: int):
+    result = await db.execute(
+        select(models.Message)
         .filter(models.Message.chat_id == chat_id)
         .order_by(desc_op(models.Message.sent_datetime))
-        .first()
     )
+    model = result.scalars().first()
     return (
         schemas.MessageResponse(
             message_id=model.message_id,
@@ -145,17 +231,71 @@ def get_last_message(db: Session, user_id: int, chat_id: int):
     )
 
 
-def get_connector(db: Session, user_id: int, connector_id: int) -> models.Connector:
-    connector = (
-        db.query(models.Connector)
-        .filter(
-            models.Connector.user_id == user_id,
-            models.Connector.connector_id == connector_id,
+async def update_last_messages(db: AsyncSession, messages: Iterable[Dict]):
+    """Point chats to the given messages (rows with chat_id, message_id and
+    sent_datetime), unless a chat already has a newer last message. Does not commit."""
+
+    chats = models.Chat.__table__
+
+    rows = [
+        dict(
+            b_chat_id=message["chat_id"],
+            b_message_id=message["message_id"],
+            b_sent_datetime=message["sent_datetime"],
         )
-        .first()
+        for message in messages
+    ]
+
+    if not rows:
+        return
+
+    await db.execute(
+        update(chats)
+        .where(
+            chats.c.chat_id == bindparam("b_chat_id"),
+            or_(
+                chats.c.last_activity_at.is_(None),
+                chats.c.last_activity_at <= bindparam("b_sent_datetime"),
+            ),
+        )
+        .values(
+            last_message_id=bindparam("b_message_id"),
+            last_activity_at=bindparam("b_sent_datetime"),
+        ),
+        rows,
     )
 
-    if not connector:
+
+async def refresh_last_message(db: AsyncSession, chat_id: int):
+    """Look up the newest message of a chat again, e.g. after a message was deleted.
+    Does not commit."""
+
+    result = await db.execute(
+        select(models.Message.message_id, models.Message.sent_datetime)
+        .filter(models.Message.chat_id == chat_id)
+        .order_by(
+            desc_op(models.Message.sent_datetime), desc_op(models.Message.message_id)
+        )
+        .limit(1)
+    )
+    last_message = result.first()
+
+    await db.execute(
+        update(models.Chat.__table__)
+        .where(models.Chat.__table__.c.chat_id == chat_id)
+        .values(
+            last_message_id=last_message.message_id if last_message else None,
+            last_activity_at=last_message.sent_datetime if last_message else None,
+        )
+    )
+
+
+async def get_connector(
+    db: AsyncSession, user_id: int, connector_id: int
+) -> models.Connector:
+    connector = await get_cached_connector(db, connector_id)
+
+    if not connector or connector.user_id != user_id:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Connector {connector_id} not found.",
@@ -164,22 +304,244 @@ def get_connector(db: Session, user_id: int, connector_id: int) -> models.Connec
     return connector
 
 
-def get_connector_by_connector_id(
-    db: Session, connector_type: str, connector_id: int
+async def get_connector_by_connector_id(
+    db: AsyncSession, connector_type: str, connector_id: int
 ) -> models.Connector:
-    connector = (
-        db.query(models.Connector)
-        .filter(
-            models.Connector.connector_type == connector_type,
-            models.Connector.connector_id == connector_id,
+    connector = await get_cached_connector(db, connector_id)
+
+    if not connector or connector.connector_type != connector_type:
+        return None
+
+    return connector
+
+
+async def get_cached_connector(
+    db: AsyncSession, connector_id: int
+) -> Optional[models.Connector]:
+    """Get a connector by id, from the connector cache if possible.
+    Cached connectors are added to the session without querying the database."""
+
+    values = connector_cache.get(connector_id)
+
+    if values is MISSING:
+        result = await db.execute(
+            select(models.Connector).filter(
+                models.Connector.connector_id == connector_id
+            )
+        )
+        connector = result.scalars().first()
+        connector_cache.set(
+            connector_id,
+            {
+                column.key: getattr(connector, column.key)
+                for column in models.Connector.__table__.columns
+            }
+            if connector
+            else None,
         )
-        .first()
+        return connector
+
+    if values is None:
+        return None
+
+    connector = models.Connector(**values)
+    make_transient_to_detached(connector)
+    return await db.merge(connector, load=False)
+
+
+async def delete_connector(db: AsyncSession, connector_id: int):
+    """Delete a connector with its chats, messages and contacts. Does not commit.
+    Foreign keys are not enforced by SQLite, so nothing is deleted with it."""
+
+    chat_ids = select(models.Chat.chat_id).filter(
+        models.Chat.connector_id == connector_id
     )
-    return connector
+    contact_ids = select(models.Contact.contact_id).filter(
+        models.Contact.connector_id == connector_id
+    )
+
+    for statement in (
+        delete(models.Message).filter(models.Message.chat_id.in_(chat_ids)),
+        delete(models.ContactsChatsRelationship).filter(
+            or_(
+                models.ContactsChatsRelationship.chat_id.in_(chat_ids),
+                models.ContactsChatsRelationship.contact_id.in_(contact_ids),
+            )
+        ),
+        delete(models.Chat).filter(models.Chat.connector_id == connector_id),
+        delete(models.Contact).filter(models.Contact.connector_id == connector_id),
+        delete(models.Connector).filter(models.Connector.connector_id == connector_id),
+    ):
+        await db.execute(statement.execution_options(synchronize_session=False))
+
+
+async def invalidate_connector(connector_id: int):
+    """Forget the cached connector in all server processes, after it was created,
+    changed or deleted."""
+
+    drop_connector(connector_id)
+    await publish_invalidation(
+        dependencies.mqtt, f"moca/invalidate/connector/{connector_id}"
+    )
+
+
+def drop_connector(connector_id: int):
+    connector_cache.invalidate(connector_id)
+
+
+def handle_invalidation(topic: str) -> bool:
+    """Drop the cached connector or contact ids an invalidation message is about.
+    Returns False if the topic is not a connector invalidation topic."""
+
+    parts = topic.split("/")
+
+    if parts[:2] != ["moca", "invalidate"] or len(parts) != 4:
+        return False
+
+    if parts[2] == "connector":
+        if parts[3].isdigit():
+            drop_connector(int(parts[3]))
+    elif parts[2] == "contacts":
+        if parts[3].isdigit():
+            drop_connector_contacts(int(parts[3]))
+    else:
+        return False
+
+    return True
+
+
+async def record_changes(
+    db: AsyncSession,
+    user_id: int,
+    kind: str,
+    object_ids: Iterable[int],
+    deleted: bool = False,
+):
+    """Log that chats, messages or contacts (the kind) of a user changed or were
+    deleted, replacing their earlier entries. Does not commit. Should be the last
+    write of a transaction, so its change ids are taken just before the commit.
+
+    Clients read the log up to the highest change id they have seen, so change ids
+    have to become visible in order. SQLite has one writer at a time anyway. On
+    PostgreSQL, transactions that write to the log hold a lock until they commit,
+    otherwise a later change id could be committed before an earlier one."""
+
+    object_ids = list(dict.fromkeys(object_ids))
 
+    if not object_ids:
+        return
 
-def get_id(connector_id: int, internal_id: str):
-    return hash(internal_id) ^ connector_id
+    if db.get_bind().dialect.name == "postgresql":
+        await db.execute(select(func.pg_advisory_xact_lock(CHANGES_LOCK)))
+
+    # Stay below the maximum number of query parameters
+    for i in range(0, len(object_ids), 500):
+        await db.execute(
+            delete(models.Change)
+            .filter(
+                models.Change.kind == kind,
+                models.Change.object_id.in_(object_ids[i : i + 500]),
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+    await db.execute(
+        insert(models.Change),
+        [
+            dict(user_id=user_id, kind=kind, object_id=object_id, deleted=deleted)
+            for object_id in object_ids
+        ],
+    )
+
+
+async def record_chats_deleted(db: AsyncSession, user_id: int, chat_ids: List[int]):
+    """Log that chats of a user were deleted. Their messages are deleted with them,
+    so the entries of the messages are dropped instead of replaced."""
+
+    for i in range(0, len(chat_ids), 500):
+        await db.execute(
+            delete(models.Change)
+            .filter(
+                models.Change.kind == "message",
+                models.Change.object_id.in_(
+                    select(models.Message.message_id).filter(
+                        models.Message.chat_id.in_(chat_ids[i : i + 500])
+                    )
+                ),
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+    await record_changes(db, user_id, "chat", chat_ids, deleted=True)
+
+
+def prepare_message(chat_id, message_id, message):
+    msg = json.loads(message)
+    if "url" in msg:
+        msg["url"] = f"/chats/{chat_id}/messages/{message_id}/media"
+    return msg
+
+
+def get_id(connector_id: int, internal_id: str) -> int:
+    """Id of a contact or chat of a connector."""
+    return stable_id(connector_id, internal_id)
+
+
+def get_message_id(connector_id: int, internal_id: str, chat_id: int) -> int:
+    return stable_id(connector_id, chat_id, internal_id)
+
+
+async def upsert(
+    db: AsyncSession,
+    model,
+    rows: List[Dict],
+    update: Optional[List[str]] = None,
+    version: Optional[str] = None,
+):
+    """Insert rows in one batch. Rows whose primary key already exists get the
+    columns in `update` overwritten, or are left as they are if `update` is empty.
+    With a `version` column, existing rows that are newer than the given ones are
+    left as they are too. Uses INSERT ... ON CONFLICT on SQLite and PostgreSQL.
+    Does not commit."""
+
+    if not rows:
+        return
+
+    table = model.__table__
+    keys = [column.name for column in table.primary_key]
+    dialect = db.get_bind().dialect.name
+
+    if dialect not in ("sqlite", "postgresql"):
+        for row in rows:
+            existing = await db.get(model, tuple(row[key] for key in keys))
+
+            if existing is None:
+                db.add(model(**row))
+                continue
+
+            current = getattr(existing, version) if version else None
+
+            if current is None or current <= row[version]:
+                for column in update or []:
+                    setattr(existing, column, row[column])
+
+        return
+
+    insert = sqlite.insert if dialect == "sqlite" else postgresql.insert
+    statement = insert(table)
+
+    if update:
+        statement = statement.on_conflict_do_update(
+            index_elements=keys,
+            set_={column: statement.excluded[column] for column in update},
+            where=None
+            if version is None
+            else or_(
+                table.c[version].is_(None),
+                table.c[version] <= statement.excluded[version],
+            ),
+        )
+    else:
+        statement = statement.on_conflict_do_nothing(index_elements=keys)
 
-def get_message_id(connector_id: int, internal_id: str, chat_id: str):
-    return hash(chat_id) ^ hash(internal_id) ^ connector_id
+    await db.execute(statement, rows)
@@ -1,13 +1,90 @@
-from sqlalchemy import create_engine
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# e.g. postgresql://moca:password@db/moca (needs psycopg2 and asyncpg)
+SQLALCHEMY_DATABASE_URL = os.getenv("MOCA_DATABASE_URL", "sqlite:///./moca.db")
+
+# Connections kept open per engine, and connections opened on top of them under load
+DATABASE_POOL_SIZE = int(os.getenv("MOCA_DATABASE_POOL_SIZE", 5))
+DATABASE_MAX_OVERFLOW = int(os.getenv("MOCA_DATABASE_MAX_OVERFLOW", 10))
+
+# Per connection, in bytes
+SQLITE_MMAP_SIZE = int(os.getenv("MOCA_SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+SQLITE_CACHE_SIZE = int(os.getenv("MOCA_SQLITE_CACHE_SIZE", 64 * 1024 * 1024))
+
+# Milliseconds a connection waits for a lock held by another one
+SQLITE_BUSY_TIMEOUT = int(os.getenv("MOCA_SQLITE_BUSY_TIMEOUT", 5000))
+
+# Async driver for each database backend
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg", "mysql": "aiomysql"}
+
+
+def async_url(url: str) -> str:
+    """The same database url, with the async driver of its backend."""
+
+    url = make_url(url)
+    backend = url.get_backend_name()
+
+    return str(url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}"))
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./moca.db"
 
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets requests read while ingestion writes. With it, NORMAL only syncs
+    on checkpoints, which cannot corrupt the database, but may lose the last
+    transactions on a power failure."""
+
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+
+    # Negative sizes are in KiB
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE // 1024}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.close()
+
+
+ASYNC_SQLALCHEMY_DATABASE_URL = async_url(SQLALCHEMY_DATABASE_URL)
+IS_SQLITE = make_url(SQLALCHEMY_DATABASE_URL).get_backend_name() == "sqlite"
+
+# SQLite connections are pooled too (instead of opened for every session),
+# so the pragmas and the page cache of a connection are reused.
+pool_options = dict(pool_size=DATABASE_POOL_SIZE, max_overflow=DATABASE_MAX_OVERFLOW)
+
+# Synchronous engine, for creating the schema and for scripts
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False} if IS_SQLITE else {},
+    poolclass=QueuePool,
+    **pool_options,
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=True, bind=engine)
 
+# Used by the request handlers and the service handler, so queries do not block the event loop.
+# Objects stay usable after a commit, because attributes cannot be lazy loaded in async code.
+async_engine = create_async_engine(
+    ASYNC_SQLALCHEMY_DATABASE_URL,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_pre_ping=not IS_SQLITE,
+    **pool_options,
+)
+AsyncSessionLocal = sessionmaker(
+    async_engine,
+    class_=AsyncSession,
+    autocommit=False,
+    autoflush=True,
+    expire_on_commit=False,
+)
+
+if IS_SQLITE:
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+
 Base = declarative_base()
 Base.metadata.bind = engine
@@ -1,9 +1,15 @@
+from app.events import EventBus
+from app.ingestion import IngestionQueue
+from app.media_cache import MediaCache
+from app.password_hasher import PasswordHasher
 from app.pool import Pool
+from app.session_cache import SessionCache
 from fastapi_mqtt.config import MQQTConfig
 from fastapi_mqtt.fastmqtt import FastMQTT
 from app import crud, models, service_handler
-from sqlalchemy.orm.session import Session
-from app.database import SessionLocal
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import AsyncSessionLocal
 from datetime import datetime, timedelta
 from typing import Optional
 from app.schemas import AuthUser, Pagination, UserResponse
@@ -12,7 +18,6 @@ from fastapi.security import OAuth2PasswordBearer
 from fastapi import HTTPException, status
 from passlib.context import CryptContext
 from jose import JWTError, jwt
-import json
 import os
 
 # WARNING! This is a dev key only. DO NOT use this in production.
@@ -20,9 +25,57 @@ SECRET_KEY = os.getenv("MOCA_SECRET_KEY", "secret_key")
 ALGORITHM = "HS256"
 MQTT_HOST = os.getenv("MOCA_MQTT_HOST", "localhost")
 
+# Workers subscribe to pushed data as one MQTT 5 shared subscription group, so every
+# push is handled by one worker. Empty to have every worker handle every push.
+MQTT_SHARE_GROUP = os.getenv("MOCA_MQTT_SHARE_GROUP", "moca")
+PUSH_TOPIC = (
+    f"$share/{MQTT_SHARE_GROUP}/moca/via/#" if MQTT_SHARE_GROUP else "moca/via/#"
+)
+
+# Connector types that answer on the shared response topics (comma separated)
+MULTIPLEXED_CONNECTORS = [
+    connector_type
+    for connector_type in os.getenv("MOCA_MULTIPLEXED_CONNECTORS", "").split(",")
+    if connector_type
+]
+
+MEDIA_CACHE_DIR = os.getenv("MOCA_MEDIA_CACHE_DIR", "./media_cache")
+MEDIA_CACHE_SIZE = int(os.getenv("MOCA_MEDIA_CACHE_SIZE", 1024 * 1024 * 1024))
+
+# Connector types that answer get_contacts for a list of contact ids (comma separated)
+BATCH_CONTACT_CONNECTORS = [
+    connector_type
+    for connector_type in os.getenv("MOCA_BATCH_CONTACT_CONNECTORS", "").split(",")
+    if connector_type
+]
+
+# Number of workers that handle pushed data, and number of pushes queued per connector
+INGESTION_WORKERS = int(os.getenv("MOCA_INGESTION_WORKERS", 4))
+INGESTION_QUEUE_SIZE = int(os.getenv("MOCA_INGESTION_QUEUE_SIZE", 1000))
+
+# Pushes up to this size (in bytes) are live messages, larger ones are backfills
+INGESTION_LIVE_SIZE = int(os.getenv("MOCA_INGESTION_LIVE_SIZE", 16 * 1024))
+
+# Number of authenticated sessions cached, and seconds they are cached for
+SESSION_CACHE_SIZE = int(os.getenv("MOCA_SESSION_CACHE_SIZE", 10000))
+SESSION_CACHE_TTL = int(os.getenv("MOCA_SESSION_CACHE_TTL", 60))
+
+# Number of threads that hash and verify passwords,
+# and number of password operations that may wait for a thread
+PASSWORD_HASH_WORKERS = int(
+    os.getenv("MOCA_PASSWORD_HASH_WORKERS", os.cpu_count() or 1)
+)
+PASSWORD_HASH_QUEUE_SIZE = int(os.getenv("MOCA_PASSWORD_HASH_QUEUE_SIZE", 100))
+
+# Number of events kept for a client that does not read them fast enough
+EVENT_QUEUE_SIZE = int(os.getenv("MOCA_EVENT_QUEUE_SIZE", 256))
+
 ACCESS_TOKEN_EXPIRE_DAYS = 30
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+password_hasher = PasswordHasher(
+    pwd_context, PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE_SIZE
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
 
@@ -30,29 +83,51 @@ mqtt_config = MQQTConfig(host=MQTT_HOST)
 mqtt = FastMQTT(config=mqtt_config)
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-pool = Pool(mqtt)
-handler = service_handler.ServiceHandler(pool)
+pool = Pool(mqtt, MULTIPLEXED_CONNECTORS)
+events = EventBus(mqtt, EVENT_QUEUE_SIZE)
+handler = service_handler.ServiceHandler(pool, events, BATCH_CONTACT_CONNECTORS)
+ingestion = IngestionQueue(
+    handler.handle, INGESTION_WORKERS, INGESTION_QUEUE_SIZE, INGESTION_LIVE_SIZE
+)
+session_cache = SessionCache(mqtt, SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
 
 
 @mqtt.on_message()
 async def message(client, topic, payload, qos, properties):
-    message = json.loads(payload.decode())
-    pool.handle(topic, message)
-    await handler.handle(topic, message)
+    if (
+        session_cache.handle(topic)
+        or crud.handle_invalidation(topic)
+        or events.handle(topic, payload)
+    ):
+        return
+
+    # Responses go straight to their waiters, they never wait behind pushed data
+    if await pool.handle(topic, payload):
+        return
+
+    await ingestion.put(topic, payload, properties)
 
 
 def get_pool():
     return pool
 
 
+def get_events():
+    return events
+
+
+media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_SIZE)
+
+
+def get_media_cache():
+    return media_cache
+
+
 def fake_user(username: str):
     return UserResponse(
         user_id=-1,
@@ -75,29 +150,35 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
-def verify_password(plain: str, hashed: str):
+async def verify_password(plain: str, hashed: str):
     """Verify that a plain text password matches the hashed password."""
-    return pwd_context.verify(plain, hashed)
+    return await password_hasher.verify(plain, hashed)
 
 
-def get_hashed_password(password):
-    return pwd_context.hash(password)
+async def get_hashed_password(password):
+    return await password_hasher.hash(password)
 
 
-def authenticate_user(username: str, password: str, db: Session):
-    user = crud.get_user_by_username(db, username)
+async def authenticate_user(username: str, password: str, db: AsyncSession):
+    user = await crud.get_user_by_username(db, username)
 
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password(password, user.hashed_password):
         return False
 
     return user
 
 
 async def get_current_user(
-    token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)
+    token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)
 ):
+    return await authenticate_token(token, db)
+
+
+async def authenticate_token(token: str, db: AsyncSession) -> AuthUser:
+    """Get the user of an access token, or raise 401 if the token is not valid."""
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -111,19 +192,25 @@ async def get_current_user(
             raise credentials_exception
     except JWTError as e:
         raise credentials_exception
-    user = crud.get_user(db, int(sub))
+
+    auth_user = session_cache.get(jti)
+
+    if auth_user is not None and auth_user.user_id == int(sub):
+        return auth_user
+
+    generation = session_cache.generation
+    user = await crud.get_user(db, int(sub))
     if user is None:
         raise credentials_exception
 
     # get sessions and see if token is still valid
-    session = (
-        db.query(models.Session)
-        .filter(
+    result = await db.execute(
+        select(models.Session).filter(
             models.Session.session_id == int(jti),
             models.Session.valid_until > datetime.now(),
         )
-        .first()
     )
+    session = result.scalars().first()
 
     if session is None:
         raise HTTPException(
@@ -133,6 +220,7 @@ async def get_current_user(
         )
     auth_user = AuthUser.from_orm(user)
     auth_user.session_id = jti
+    session_cache.set(auth_user, session.valid_until, generation)
 
     return auth_user
 
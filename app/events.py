@@ -0,0 +1,137 @@
+import asyncio
+import json
+import logging
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Set
+
+from fastapi.encoders import jsonable_encoder
+from fastapi_mqtt.fastmqtt import FastMQTT
+
+_LOGGER = logging.getLogger(__name__)
+
+# Sent instead of the events a client missed because its queue was full.
+# The client has to reload what it shows.
+RESYNC = json.dumps({"type": "resync"})
+
+# Messages of one chat that are sent with an event. For more (e.g. a backfill),
+# the event has no messages and clients fetch them.
+MAX_EVENT_MESSAGES = 100
+
+# Fields of a chat that chat events can carry
+CHAT_EVENT_FIELDS = {"connector_id", "name", "is_muted", "is_archived", "pin_position"}
+
+
+class EventBus:
+    """Delivers events about the data of a user to the clients of that user.
+
+    Events are published on moca/events/{user_id}. Every server process
+    subscribes to moca/events/# and passes the events to the clients connected
+    to it, so a client gets all events, whichever process caused them.
+
+    Events only carry ids, so the contents of chats and messages never pass
+    through the broker. They are loaded for the client when it is sent the event."""
+
+    TOPIC = "moca/events/#"
+
+    def __init__(self, mqtt: FastMQTT, queue_size: int = 256):
+        self.mqtt = mqtt
+        self.queue_size = queue_size
+
+        # user id -> queues of the connected clients, with events as json
+        self.subscribers: Dict[int, Set[asyncio.Queue]] = {}
+
+        self.published = 0
+        self.delivered = 0
+        self.resyncs = 0
+
+    async def publish(self, user_id: int, event: Dict):
+        try:
+            await self.mqtt.publish(
+                f"moca/events/{user_id}", json.dumps(jsonable_encoder(event))
+            )
+            self.published += 1
+        except Exception:
+            _LOGGER.warning(f"Could not publish {event['type']} event.", exc_info=True)
+
+    def handle(self, topic: str, payload: bytes) -> bool:
+        """Pass an event to the clients of its user.
+        Returns False if the topic is not an event topic."""
+
+        parts = topic.split("/")
+
+        if parts[:2] != ["moca", "events"] or len(parts) != 3:
+            return False
+
+        queues = self.subscribers.get(int(parts[2])) if parts[2].isdigit() else None
+
+        if queues:
+            event = payload.decode()
+
+            for queue in queues:
+                self._put(queue, event)
+
+        return True
+
+    @contextmanager
+    def subscribe(self, user_id: int) -> Iterator[asyncio.Queue]:
+        """Queue for the events of a user, as json, while the context is open."""
+
+        queue = asyncio.Queue(self.queue_size)
+        self.subscribers.setdefault(user_id, set()).add(queue)
+
+        try:
+            yield queue
+        finally:
+            queues = self.subscribers[user_id]
+            queues.discard(queue)
+
+            if not queues:
+                del self.subscribers[user_id]
+
+    def stats(self) -> Dict:
+        return {
+            "users": len(self.subscribers),
+            "clients": sum(len(queues) for queues in self.subscribers.values()),
+            "published": self.published,
+            "delivered": self.delivered,
+            "resyncs": self.resyncs,
+        }
+
+    def _put(self, queue: asyncio.Queue, event: str):
+        if queue.full():
+            # The client is too slow, it gets one resync instead of the backlog
+            while not queue.empty():
+                queue.get_nowait()
+
+            queue.put_nowait(RESYNC)
+            self.resyncs += 1
+            return
+
+        queue.put_nowait(event)
+        self.delivered += 1
+
+
+def messages_event(chat_id: int, message_ids: List[int]) -> Dict:
+    """New or changed messages of a chat, or only their count if there are more
+    than MAX_EVENT_MESSAGES."""
+
+    return {
+        "type": "messages",
+        "chat_id": chat_id,
+        "count": len(message_ids),
+        "message_ids": message_ids if len(message_ids) <= MAX_EVENT_MESSAGES else None,
+    }
+
+
+def message_deleted_event(chat_id: int, message_id: int) -> Dict:
+    return {"type": "message_deleted", "chat_id": chat_id, "message_id": message_id}
+
+
+def chat_event(chat_id: int, *fields: str) -> Dict:
+    """Names of the changed fields of a chat (a new chat has all of them)."""
+
+    return {"type": "chat", "chat_id": chat_id, "fields": list(fields)}
+
+
+def chat_deleted_event(chat_id: int) -> Dict:
+    return {"type": "chat_deleted", "chat_id": chat_id}
@@ -0,0 +1,18 @@
+import hashlib
+import os
+
+# Key of the id hash. Changing it changes all ids, so it must stay the same for
+# the lifetime of a database (the migration that rewrote the ids used it too).
+ID_KEY = os.getenv("MOCA_ID_KEY", "moca").encode()
+
+
+def stable_id(*parts) -> int:
+    """63 bit id derived from the parts. Unlike hash(), it is the same in every
+    process, so any worker can compute the id of a row without looking it up.
+    Parts are compared as strings, so 5 and "5" give the same id."""
+
+    digest = hashlib.blake2b(
+        "/".join(str(part) for part in parts).encode(), digest_size=8, key=ID_KEY
+    ).digest()
+
+    return int.from_bytes(digest, "big") >> 1
@@ -0,0 +1,353 @@
+import asyncio
+import json
+import logging
+import math
+import time
+from collections import deque
+from datetime import datetime
+from typing import Awaitable, Callable, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+from app.stats import LATENCY_SAMPLES, percentile
+
+_LOGGER = logging.getLogger(__name__)
+
+# Bytes of pushed data a connector may have handled per scheduling round
+INGESTION_QUANTUM = 64 * 1024
+
+
+class Push(NamedTuple):
+    topic: str
+    payload: bytes
+    size: int
+    live: bool
+    queued_at: float
+    # When the push reached this server (UTC), passed on to the handler
+    received_at: datetime
+
+
+class ConnectorQueue:
+    """Pushes of one connector, in the order they arrived."""
+
+    def __init__(self):
+        self.pushes: Deque[Push] = deque()
+
+        # Bytes the connector may still have handled before it is its turn again
+        self.deficit = 0
+
+        # Whether one of its pushes is being handled
+        self.busy = False
+
+        # Producers that are held back because the queue is full, in the order
+        # they arrived, and the number of them that were let through but did not
+        # add their push yet
+        self.writers: Deque[asyncio.Future] = deque()
+        self.admitted = 0
+
+    @property
+    def empty(self) -> bool:
+        """Whether nothing of the connector is queued, handled or held."""
+
+        return not (self.pushes or self.busy or self.writers or self.admitted)
+
+
+class IngestionQueue:
+    """Queues pushed data so it is handled outside of the mqtt callback.
+
+    Every connector has its own queue, and at most one push per connector is
+    handled at a time, so pushes of one connector are handled in the order they
+    arrived. Workers take turns between the connectors with deficit round robin,
+    weighted by payload size, so a connector importing its history cannot starve
+    the others. Connectors whose next push is live (small, or flagged by the
+    service) are always served before connectors whose next push is a backfill,
+    and backfills never occupy all workers, so live pushes do not wait for them.
+    The exception is a single worker, which also handles backfills.
+
+    Once `max_size` pushes of a connector are waiting, the mqtt callbacks
+    delivering further pushes for it are held, before their pushes are queued,
+    until it catches up. Held callbacks queue their pushes in the order they
+    arrived. The mqtt client acknowledges messages before its callbacks run, so
+    holding them does not slow down the broker or the services."""
+
+    def __init__(
+        self,
+        handle: Callable[[str, Dict, datetime], Awaitable],
+        workers: int = 4,
+        max_size: int = 1000,
+        live_size: int = 16 * 1024,
+        quantum: int = INGESTION_QUANTUM,
+    ):
+        self.handle = handle
+        self.workers = workers
+        self.max_size = max_size
+        self.live_size = live_size
+        self.quantum = quantum
+
+        # connector key -> queue, only for connectors with pushes
+        self.connectors: Dict[str, ConnectorQueue] = {}
+
+        # Connectors with pushes and none being handled,
+        # by the priority of their next push
+        self.live: Deque[str] = deque()
+        self.backfill: Deque[str] = deque()
+
+        # Number of pushes that were queued and not handled yet
+        self.unfinished = 0
+
+        # Number of backfills being handled, at most max_backfills
+        # (one worker has to handle backfills too)
+        self.backfilling = 0
+        self.max_backfills = max(workers - 1, 1)
+
+        # Created on start, inside the running event loop
+        self.tasks: List[asyncio.Task] = []
+        self._ready: Optional[asyncio.Event] = None
+        self._idle: Optional[asyncio.Event] = None
+
+        self.blocked = 0
+        self.processed = 0
+        self.failed = 0
+
+        # priority -> recent times pushes waited in the queue, in seconds
+        self.waits = {
+            "live": deque(maxlen=LATENCY_SAMPLES),
+            "backfill": deque(maxlen=LATENCY_SAMPLES),
+        }
+
+    async def start(self):
+        self._ready = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
+        """Handle the queued pushes (for up to `timeout` seconds) and stop."""
+
+        if self.tasks:
+            join = asyncio.ensure_future(self.join())
+            done, _ = await asyncio.wait({join}, timeout=timeout)
+
+            if not done:
+                join.cancel()
+                _LOGGER.warning(f"Stopped with {self.unfinished} pushes left.")
+
+        for task in self.tasks:
+            task.cancel()
+
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def join(self):
+        """Wait until all queued pushes have been handled."""
+
+        await self._idle.wait()
+
+    async def put(self, topic: str, payload: bytes, properties: Optional[Dict] = None):
+        """Queue a push. Waits while the queue of its connector is full."""
+
+        received_at = datetime.utcnow()
+        key = self.connector_key(topic)
+        connector = self.connectors.get(key)
+
+        if connector is None:
+            connector = self.connectors[key] = ConnectorQueue()
+
+        self.unfinished += 1
+        self._idle.clear()
+
+        if (
+            connector.writers
+            or connector.admitted
+            or len(connector.pushes) >= self.max_size
+        ):
+            writer = asyncio.get_event_loop().create_future()
+            connector.writers.append(writer)
+            self.blocked += 1
+
+            try:
+                await writer
+            except asyncio.CancelledError:
+                if writer.cancelled():
+                    connector.writers.remove(writer)
+                else:
+                    connector.admitted -= 1
+                    self._admit(connector)
+
+                self._forget(key, connector)
+                raise
+
+            connector.admitted -= 1
+
+        connector.pushes.append(
+            Push(
+                topic,
+                payload,
+                len(payload),
+                self.is_live(payload, properties),
+                time.monotonic(),
+                received_at,
+            )
+        )
+
+        if len(connector.pushes) == 1 and not connector.busy:
+            self._schedule(key, connector)
+
+        self._admit(connector)
+
+    @staticmethod
+    def connector_key(topic: str) -> str:
+        """moca/via/{service}/{connector_id}/... topics are queued by their
+        connector, other topics by the whole topic."""
+
+        parts = topic.split("/")
+
+        return "/".join(parts[2:4]) if parts[1:2] == ["via"] else topic
+
+    def is_live(self, payload: bytes, properties: Optional[Dict] = None) -> bool:
+        """Services can flag a push with the mqtt user property moca-priority
+        (live or backfill). Otherwise small pushes are live."""
+
+        for name, value in (properties or {}).get("user_property", []):
+            if name == "moca-priority":
+                return value != "backfill"
+
+        return len(payload) <= self.live_size
+
+    def stats(self) -> Dict:
+        depths = [len(connector.pushes) for connector in self.connectors.values()]
+
+        return {
+            "workers": self.workers,
+            "max_size": self.max_size,
+            "connectors": len(self.connectors),
+            "depth": sum(depths),
+            "max_depth": max(depths, default=0),
+            "ready": {"live": len(self.live), "backfill": len(self.backfill)},
+            "backfilling": self.backfilling,
+            "held": sum(
+                len(connector.writers) + connector.admitted
+                for connector in self.connectors.values()
+            ),
+            "blocked": self.blocked,
+            "processed": self.processed,
+            "failed": self.failed,
+            "wait": {
+                priority: {
+                    "p50": percentile(waits, 0.5),
+                    "p99": percentile(waits, 0.99),
+                }
+                for priority, waits in self.waits.items()
+            },
+        }
+
+    def _schedule(self, key: str, connector: ConnectorQueue):
+        """Line up a connector for its next push."""
+
+        (self.live if connector.pushes[0].live else self.backfill).append(key)
+        self._ready.set()
+
+    def _next(self) -> Optional[Tuple[str, Push]]:
+        """Take the next push to handle, or None if there is none."""
+
+        ring = self.live
+
+        if not ring and self.backfilling < self.max_backfills:
+            ring = self.backfill
+
+        if not ring:
+            return None
+
+        connectors = [self.connectors[key] for key in ring]
+
+        # Skip the rounds in which no connector could have anything handled
+        rounds = min(
+            math.ceil((connector.pushes[0].size - connector.deficit) / self.quantum)
+            for connector in connectors
+        )
+
+        if rounds > 1:
+            for connector in connectors:
+                connector.deficit += (rounds - 1) * self.quantum
+
+        while True:
+            key = ring[0]
+            connector = self.connectors[key]
+            push = connector.pushes[0]
+
+            if connector.deficit >= push.size:
+                ring.popleft()
+                connector.pushes.popleft()
+                connector.deficit -= push.size
+                connector.busy = True
+
+                if not push.live:
+                    self.backfilling += 1
+
+                self._admit(connector)
+
+                return key, push
+
+            connector.deficit += self.quantum
+            ring.rotate(-1)
+
+    def _done(self, key: str, push: Push):
+        """Line up the connector again after one of its pushes was handled."""
+
+        connector = self.connectors[key]
+        connector.busy = False
+
+        if not push.live:
+            # Another backfill may be handled now
+            self.backfilling -= 1
+            self._ready.set()
+
+        if connector.pushes:
+            self._schedule(key, connector)
+
+        self._forget(key, connector)
+
+    def _admit(self, connector: ConnectorQueue):
+        """Let held callbacks through while there is room for their pushes."""
+
+        while (
+            connector.writers
+            and len(connector.pushes) + connector.admitted < self.max_size
+        ):
+            connector.admitted += 1
+            connector.writers.popleft().set_result(None)
+
+    def _forget(self, key: str, connector: ConnectorQueue):
+        """Count a push as finished, and drop the queue of its connector once
+        nothing of the connector is queued, handled or held anymore."""
+
+        if connector.empty and self.connectors.get(key) is connector:
+            del self.connectors[key]
+
+        self.unfinished -= 1
+
+        if not self.unfinished:
+            self._idle.set()
+
+    async def _work(self):
+        while True:
+            item = self._next()
+
+            if item is None:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+
+            key, push = item
+            self.waits["live" if push.live else "backfill"].append(
+                time.monotonic() - push.queued_at
+            )
+
+            try:
+                await self.handle(
+                    push.topic, json.loads(push.payload.decode()), push.received_at
+                )
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                _LOGGER.exception(f"Could not handle push on {push.topic}.")
+            finally:
+                self._done(key, push)
@@ -1,39 +1,53 @@
-from fastapi import FastAPI
-from fastapi.params import Depends
-from setuptools_scm import get_version
-from starlette.responses import RedirectResponse
-from app.routers import (
-    auth,
-    chats,
-    connectors,
-    contacts,
-    debug,
-    messages,
-    sessions,
-    users,
-    info,
-)
-from app.dependencies import mqtt
+from app.startup import startup_report
+
+with startup_report.measure("import fastapi"):
+    from fastapi import FastAPI
+    from starlette.responses import RedirectResponse
+
+with startup_report.measure("import app.dependencies"):
+    from app.database import async_engine
+    from app.dependencies import (
+        PUSH_TOPIC,
+        events,
+        ingestion,
+        mqtt,
+        password_hasher,
+        session_cache,
+    )
+    from app.pool import Pool
+
+with startup_report.measure("resolve version"):
+    from app.version import VERSION
+
+import importlib
 import logging
-from fastapi_mqtt import FastMQTT, MQQTConfig
 
 _LOGGER = logging.getLogger(__name__)
 
 app = FastAPI(
     title="MOCA Server",
     description="API documentation for the MOCA mobile chat aggregator project.",
-    version=get_version(),
+    version=VERSION,
 )
 
-app.include_router(info.router)
-app.include_router(debug.router)
-app.include_router(auth.router)
-app.include_router(users.router)
-app.include_router(sessions.router)
-app.include_router(contacts.router)
-app.include_router(chats.router)
-app.include_router(messages.router)
-app.include_router(connectors.router)
+# Modules in app.routers, in the order their routers are included
+ROUTERS = [
+    "info",
+    "debug",
+    "auth",
+    "users",
+    "sessions",
+    "contacts",
+    "chats",
+    "messages",
+    "connectors",
+    "events",
+    "sync",
+]
+
+for name in ROUTERS:
+    with startup_report.measure(f"app.routers.{name}"):
+        app.include_router(importlib.import_module(f"app.routers.{name}").router)
 
 
 @app.get("/")
@@ -45,17 +59,34 @@ async def redirect_to_docs():
 
 @app.on_event("startup")
 async def startapp():
-    await mqtt.connection()
+    with startup_report.measure("start ingestion"):
+        await ingestion.start()
+
+    with startup_report.measure("connect to mqtt"):
+        await mqtt.connection()
+
+    startup_report.finish()
 
 
 @app.on_event("shutdown")
 async def shutdown():
     await mqtt.client.disconnect()
+    await ingestion.stop()
+    await async_engine.dispose()
+    password_hasher.shutdown()
 
 
 @mqtt.on_connect()
 def connect(client, flags, rc, properties):
-    mqtt.client.subscribe("moca/#")  # subscribing mqtt topic
+    mqtt.client.subscribe(PUSH_TOPIC)
+
+    # Every worker needs the responses to its own requests, all invalidations
+    # and all events
+    mqtt.client.subscribe(session_cache.TOPIC)
+    mqtt.client.subscribe(events.TOPIC)
+
+    for topic in Pool.RESPONSE_TOPICS:
+        mqtt.client.subscribe(topic)
 
 
 @mqtt.on_disconnect()
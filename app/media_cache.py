@@ -0,0 +1,288 @@
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import AsyncIterator, BinaryIO, Iterator, List, NamedTuple, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+
+# Bytes of a streamed file that are collected before they are written
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Share of the size budget the cache is evicted down to, so it is not evicted
+# again with every file that is stored
+EVICT_TO = 0.9
+
+
+class CachedMedia(NamedTuple):
+    path: str
+    digest: str
+    filename: Optional[str]
+    mime: Optional[str]
+    stat: os.stat_result
+    # Open for reading, so the file can still be sent if it is evicted meanwhile
+    file: Optional[BinaryIO] = None
+
+
+class MediaCache:
+    """Keeps media files of messages on disk, shared by all workers.
+
+    Files are stored under the sha256 of their content, so a file attached to
+    several messages is only stored once. For every message, a small index file
+    points to the stored file. Reading a message's file touches its index file.
+
+    The directory is the only state, so the workers share one size budget. The
+    size of the stored files is kept in a file next to them, and storing files
+    and evicting them hold a lock on the directory. Once the stored files exceed
+    the budget, the least recently used index files are removed until they fit
+    EVICT_TO of it, and a stored file is removed once no index file points to it
+    anymore. Files are opened when they are looked up, and a file that is gone
+    is a cache miss. All file operations run in the thread pool."""
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = Path(directory)
+        self.blobs = self.directory / "blobs"
+        self.index = self.directory / "messages"
+        self.max_size = max_size
+
+    async def get(self, message_id: int) -> Optional[CachedMedia]:
+        """Get the cached file of a message, opened for reading."""
+
+        return await run_in_threadpool(self._open, message_id)
+
+    async def put(
+        self, message_id: int, filename: Optional[str], mime: Optional[str], data: bytes
+    ) -> CachedMedia:
+        """Store the file of a message."""
+
+        temp_path = await run_in_threadpool(self._write_temp, data)
+
+        return await run_in_threadpool(
+            self._store,
+            message_id,
+            filename,
+            mime,
+            temp_path,
+            hashlib.sha256(data).hexdigest(),
+        )
+
+    async def tee(
+        self,
+        message_id: int,
+        filename: Optional[str],
+        mime: Optional[str],
+        chunks: AsyncIterator[bytes],
+    ) -> AsyncIterator[bytes]:
+        """Pass chunks through while storing them.
+        The file is only added to the cache if all chunks were received."""
+
+        temp_path = await run_in_threadpool(self._write_temp, b"")
+        digest = hashlib.sha256()
+        buffer = []
+        buffered = 0
+        complete = False
+
+        try:
+            async for chunk in chunks:
+                digest.update(chunk)
+                buffer.append(chunk)
+                buffered += len(chunk)
+
+                if buffered >= WRITE_BUFFER_SIZE:
+                    await run_in_threadpool(self._append, temp_path, buffer)
+                    buffer = []
+                    buffered = 0
+
+                yield chunk
+
+            await run_in_threadpool(self._append, temp_path, buffer)
+            complete = True
+        finally:
+            if complete:
+                await run_in_threadpool(
+                    self._store,
+                    message_id,
+                    filename,
+                    mime,
+                    temp_path,
+                    digest.hexdigest(),
+                )
+            else:
+                await run_in_threadpool(os.unlink, temp_path)
+
+    @staticmethod
+    def read(
+        file: BinaryIO, first: int, last: int, chunk_size: int = 64 * 1024
+    ) -> Iterator[bytes]:
+        """Read the bytes first to last (inclusive) of an opened cached file,
+        and close it."""
+
+        with file:
+            file.seek(first)
+            remaining = last - first + 1
+
+            while remaining > 0:
+                chunk = file.read(min(chunk_size, remaining))
+
+                if not chunk:
+                    break
+
+                remaining -= len(chunk)
+                yield chunk
+
+    def evict(self, target: int) -> int:
+        """Remove the least recently used index files until the stored files fit
+        into target bytes, and the stored files no index file points to.
+        Must hold the lock. Returns the size of the stored files."""
+
+        entries = []
+
+        for index_path in self.index.glob("*.json"):
+            try:
+                digest = json.loads(index_path.read_text())["digest"]
+                entries.append((index_path.stat().st_mtime, index_path, digest))
+            except (OSError, ValueError, KeyError):
+                continue
+
+        references = Counter(digest for _, _, digest in entries)
+        sizes = {path.name: path.stat().st_size for path in self.blobs.iterdir()}
+
+        for digest in set(sizes) - set(references):
+            self._remove(self.blobs / digest)
+            del sizes[digest]
+
+        total = sum(sizes.values())
+
+        for _, index_path, digest in sorted(entries, key=lambda entry: entry[0]):
+            if total <= target:
+                break
+
+            self._remove(index_path)
+            references[digest] -= 1
+
+            if not references[digest] and digest in sizes:
+                self._remove(self.blobs / digest)
+                total -= sizes.pop(digest)
+
+        return total
+
+    def _open(self, message_id: int) -> Optional[CachedMedia]:
+        index_path = self.index / f"{message_id}.json"
+
+        try:
+            entry = json.loads(index_path.read_text())
+            path = self.blobs / entry["digest"]
+            file = open(path, "rb")
+        except (OSError, ValueError, KeyError):
+            return None
+
+        try:
+            os.utime(index_path)
+        except OSError:
+            # Evicted meanwhile, the opened file can still be read
+            pass
+
+        return CachedMedia(
+            str(path),
+            entry["digest"],
+            entry.get("filename"),
+            entry.get("mime"),
+            os.fstat(file.fileno()),
+            file,
+        )
+
+    @contextmanager
+    def _locked(self):
+        """Hold the lock on the directory, shared by all workers."""
+
+        self._prepare()
+
+        with open(self.directory / "lock", "a") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def _read_total(self) -> int:
+        try:
+            return int((self.directory / "size").read_text())
+        except (OSError, ValueError):
+            return sum(path.stat().st_size for path in self.blobs.iterdir())
+
+    def _write_total(self, total: int):
+        (self.directory / "size").write_text(str(total))
+
+    def _prepare(self):
+        self.blobs.mkdir(parents=True, exist_ok=True)
+        self.index.mkdir(parents=True, exist_ok=True)
+
+    def _write_temp(self, data: bytes) -> str:
+        self._prepare()
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+
+        return temp_path
+
+    @staticmethod
+    def _append(path: str, chunks: List[bytes]):
+        with open(path, "ab") as file:
+            file.writelines(chunks)
+
+    def _store(
+        self,
+        message_id: int,
+        filename: Optional[str],
+        mime: Optional[str],
+        temp_path: str,
+        digest: str,
+    ) -> CachedMedia:
+        """Move a completely written file into the cache and index it for the
+        message, then evict if the cache is over its budget."""
+
+        path = self.blobs / digest
+
+        with self._locked():
+            added = 0
+
+            if path.exists():
+                os.unlink(temp_path)
+            else:
+                os.replace(temp_path, path)
+                added = path.stat().st_size
+
+            fd, temp_index_path = tempfile.mkstemp(dir=self.directory)
+
+            with os.fdopen(fd, "w") as file:
+                json.dump({"digest": digest, "filename": filename, "mime": mime}, file)
+
+            os.replace(temp_index_path, self.index / f"{message_id}.json")
+            cached = CachedMedia(str(path), digest, filename, mime, path.stat())
+
+            total = self._read_total() + added
+
+            if total > self.max_size:
+                total = self.evict(int(self.max_size * EVICT_TO))
+
+            self._write_total(total)
+
+        return cached
+
+    @staticmethod
+    def _remove(path: Path) -> int:
+        """Remove a file and return its size."""
+
+        try:
+            size = path.stat().st_size
+            path.unlink()
+            return size
+        except OSError:
+            return 0
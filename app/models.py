@@ -1,24 +1,41 @@
-from sqlalchemy import Column, Table, ForeignKey, Integer, String, Boolean, DateTime
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    Table,
+)
 from sqlalchemy.orm import relationship, backref
 from .database import Base
 from sqlalchemy.sql import func
 
+# Type of the 63 bit ids of contacts, chats and messages (see app.ids).
+# SQLite integers have 64 bits already, and only INTEGER primary keys are rowids.
+Id = BigInteger().with_variant(Integer(), "sqlite")
+
 # many to many relationship
 class ContactsChatsRelationship(Base):
     __tablename__ = "contacts_chats_relationship"
 
-    contact_id = Column(Integer, ForeignKey("contacts.contact_id"), primary_key=True)
-    chat_id = Column(Integer, ForeignKey("chats.chat_id"), primary_key=True)
+    contact_id = Column(Id, ForeignKey("contacts.contact_id"), primary_key=True)
+    chat_id = Column(Id, ForeignKey("chats.chat_id"), primary_key=True)
 
     contact = relationship("Contact", back_populates="chats")
     chat = relationship("Chat", back_populates="contacts")
 
+    # The primary key only covers lookups by contact
+    __table_args__ = (Index("ix_contacts_chats_relationship_chat_id", "chat_id"),)
+
 
 class User(Base):
     __tablename__ = "users"
 
     user_id = Column(Integer, primary_key=True)
-    username = Column(String(255))
+    username = Column(String(255), index=True)
     mail = Column(String(255))
     hashed_password = Column(String(255))
     is_verified = Column(Boolean())
@@ -38,7 +55,7 @@ class User(Base):
 class Contact(Base):
     __tablename__ = "contacts"
 
-    contact_id = Column(Integer, primary_key=True, autoincrement=True)
+    contact_id = Column(Id, primary_key=True, autoincrement=True)
     internal_id = Column(
         String,
         comment="ID that the connector uses to refer to this contact.",
@@ -55,10 +72,16 @@ class Contact(Base):
         nullable=True,
     )
     is_self = Column(Boolean, nullable=False, default=False)
+    # When the push the row was last written from reached the server
+    pushed_at = Column(DateTime(), nullable=True)
     messages = relationship("Message", backref="contacts", lazy=True)
 
     chats = relationship("ContactsChatsRelationship", back_populates="contact")
 
+    __table_args__ = (
+        Index("ix_contacts_connector_id_internal_id", "connector_id", "internal_id"),
+    )
+
     def __repr__(self):
         return "<Contact %s@%s>" % (self.name, self.service_id)
 
@@ -66,21 +89,36 @@ class Contact(Base):
 class Chat(Base):
     __tablename__ = "chats"
 
-    chat_id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(Id, primary_key=True, autoincrement=True)
     internal_id = Column(
         String, comment="ID that the connector uses to refer to this chat."
     )
     connector_id = Column(
         Integer, ForeignKey("connectors.connector_id"), nullable=False
     )
+    # Copy of the user of the connector, so listing chats needs no join
+    user_id = Column(Integer, nullable=True)
     name = Column(String(255))
     # chat_type = Column(String(255))
     is_muted = Column(Boolean())
     is_archived = Column(Boolean())
     pin_position = Column(Integer(), nullable=True)
+    # When the push the row was last written from reached the server
+    pushed_at = Column(DateTime(), nullable=True)
+
+    # Newest message of the chat, kept up to date when messages are added or deleted
+    last_message_id = Column(Id, nullable=True)
+    last_activity_at = Column(DateTime(), nullable=True)
+
     contacts = relationship("ContactsChatsRelationship", back_populates="chat")
     messages = relationship("Message", backref="chats", lazy=True)
 
+    __table_args__ = (
+        Index("ix_chats_connector_id_internal_id", "connector_id", "internal_id"),
+        # Chats of a user, most recently active first
+        Index("ix_chats_user_id_last_activity_at", "user_id", "last_activity_at"),
+    )
+
     def __repr__(self):
         return "<Chat %s>" % self.name
 
@@ -88,20 +126,27 @@ class Chat(Base):
 class Message(Base):
     __tablename__ = "messages"
 
-    message_id = Column(Integer, primary_key=True, autoincrement=True)
+    message_id = Column(Id, primary_key=True, autoincrement=True)
     internal_id = Column(
         String,
         comment="ID that the connector uses to refer to this message.",
     )
 
     contact_id = Column(
-        Integer, ForeignKey("contacts.contact_id", ondelete="CASCADE"), nullable=False
+        Id, ForeignKey("contacts.contact_id", ondelete="CASCADE"), nullable=False
     )
     chat_id = Column(
-        Integer, ForeignKey("chats.chat_id", ondelete="CASCADE"), nullable=False
+        Id, ForeignKey("chats.chat_id", ondelete="CASCADE"), nullable=False
     )
     message = Column(String())  # JSON
     sent_datetime = Column(DateTime())
+    # When the push the row was last written from reached the server
+    pushed_at = Column(DateTime(), nullable=True)
+
+    # Messages of a chat, newest first
+    __table_args__ = (
+        Index("ix_messages_chat_id_sent_datetime", "chat_id", "sent_datetime"),
+    )
 
     def __repr__(self):
         return "<Message %s>" % self.message_id
@@ -112,7 +157,7 @@ class Connector(Base):
 
     connector_id = Column(Integer, primary_key=True)
     connector_type = Column(String(255))
-    user_id = Column(Integer, ForeignKey("users.user_id"))
+    user_id = Column(Integer, ForeignKey("users.user_id"), index=True)
     connector_user_id = Column(String(255))
     configuration = Column(String())  # JSON
     is_finished = Column(Boolean(), nullable=False, default=False)
@@ -130,5 +175,38 @@ class Session(Base):
     name = Column(String(255))
     valid_until = Column(DateTime())
 
+    # Valid sessions of a user
+    __table_args__ = (
+        Index("ix_sessions_user_id_valid_until", "user_id", "valid_until"),
+    )
+
     def __repr__(self):
         return "<Session %s (%s)>" % (self.session_id, self.name)
+
+
+class Change(Base):
+    """Latest change of each chat, message and contact of a user, for /sync.
+
+    Every change replaces the earlier entry of its object with a new one, so
+    the change ids are a sequence the clients can read from, and each object
+    has one entry."""
+
+    __tablename__ = "changes"
+    __table_args__ = (
+        # Changes of a user after a change id
+        Index("ix_changes_user_id_change_id", "user_id", "change_id"),
+        # Earlier entry of an object
+        Index("ix_changes_kind_object_id", "kind", "object_id"),
+        # Change ids are never reused, even after the last entry was replaced
+        {"sqlite_autoincrement": True},
+    )
+
+    change_id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, nullable=False)
+    kind = Column(String(16), nullable=False, comment="chat, message or contact")
+    object_id = Column(Id, nullable=False)
+    deleted = Column(Boolean(), nullable=False, default=False)
+    changed_at = Column(DateTime, nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return "<Change %s (%s %s)>" % (self.change_id, self.kind, self.object_id)
@@ -0,0 +1,109 @@
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+from app.stats import LATENCY_SAMPLES, percentile
+
+
+class PasswordHasher:
+    """Hashes and verifies passwords in a thread pool, so bcrypt does not block
+    the event loop.
+
+    At most `workers` operations run at once and up to `max_queued` wait for a
+    thread. Further operations are rejected with 503, so a burst of logins
+    cannot queue up without bound."""
+
+    def __init__(self, context: CryptContext, workers: int = 4, max_queued: int = 100):
+        self.context = context
+        self.workers = workers
+        self.max_queued = max_queued
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="password")
+
+        # Operations that were submitted and did not finish yet. Counted until
+        # the thread is done, even if the caller stopped waiting for it.
+        self.pending = 0
+
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+        # Recent times operations waited for a thread and ran, in seconds.
+        # Appended to from the threads, which is safe for deques.
+        self.waits = deque(maxlen=LATENCY_SAMPLES)
+        self.durations = deque(maxlen=LATENCY_SAMPLES)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.context.hash, password)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._run(self.context.verify, password, hashed)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def stats(self) -> Dict:
+        return {
+            "workers": self.workers,
+            "max_queued": self.max_queued,
+            "running": min(self.pending, self.workers),
+            "queued": max(self.pending - self.workers, 0),
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "wait": {
+                "p50": percentile(self.waits, 0.5),
+                "p99": percentile(self.waits, 0.99),
+            },
+            "duration": {
+                "p50": percentile(self.durations, 0.5),
+                "p99": percentile(self.durations, 0.99),
+            },
+        }
+
+    async def _run(self, function: Callable, *args):
+        if self.pending >= self.workers + self.max_queued:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many logins at the moment. Please try again.",
+                headers={"Retry-After": "1"},
+            )
+
+        queued_at = time.monotonic()
+
+        def run():
+            started = time.monotonic()
+
+            try:
+                return function(*args)
+            finally:
+                self.waits.append(started - queued_at)
+                self.durations.append(time.monotonic() - started)
+
+        loop = asyncio.get_event_loop()
+        future = self.executor.submit(run)
+        self.pending += 1
+
+        # Called in the thread (or right away for cancelled operations),
+        # the counters are only changed in the event loop
+        future.add_done_callback(
+            lambda future: loop.call_soon_threadsafe(self._finished, future)
+        )
+
+        return await asyncio.wrap_future(future)
+
+    def _finished(self, future: Future):
+        self.pending -= 1
+
+        if future.cancelled():
+            return
+
+        if future.exception() is not None:
+            self.failed += 1
+        else:
+            self.completed += 1
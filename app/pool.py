@@ -1,121 +1,437 @@
-from queue import Queue, Empty
 import base64
 import asyncio
-from typing import Dict, Tuple
+from collections import deque
+from operator import itemgetter
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Optional,
+    Tuple,
+    Union,
+)
 import json
 from fastapi_mqtt.fastmqtt import FastMQTT
-from fastapi import HTTPException, status
-from starlette.status import HTTP_504_GATEWAY_TIMEOUT
+from fastapi import HTTPException
+from starlette.status import HTTP_502_BAD_GATEWAY, HTTP_504_GATEWAY_TIMEOUT
+
+# Number of chunks a streamed response may buffer before the sender is held back
+STREAM_BUFFER_SIZE = 16
+
+
+def decode_chunk(chunk: Dict) -> bytes:
+    """Get the bytes of a chunk, which are either raw or base64 encoded."""
+
+    data = chunk.get("data")
+    return data if isinstance(data, bytes) else base64.b64decode(data)
+
+
+class ChunkBuffer:
+    """Buffer for the chunks of a response.
+
+    Chunks are kept in the order they arrived. Once `size` chunks are waiting,
+    the handlers delivering further chunks are held, before their chunks are
+    added, until the reader catches up or the buffer is closed. Held handlers
+    add their chunks in the order they arrived. A size of 0 means unbounded."""
+
+    def __init__(self, size: int = 0):
+        self.size = size
+        self.chunks = deque()
+        self.closed = False
+        self._readable = asyncio.Event()
+
+        # Held handlers, and the number of them that were let through but did
+        # not add their chunk yet
+        self._writers = deque()
+        self._admitted = 0
+
+    async def put(self, chunk: Dict):
+        if self.size and (self._writers or self._admitted or self._full()):
+            writer = asyncio.get_event_loop().create_future()
+            self._writers.append(writer)
+
+            try:
+                await writer
+            except asyncio.CancelledError:
+                if writer.cancelled():
+                    self._writers.remove(writer)
+                else:
+                    self._admitted -= 1
+                    self._admit()
+                raise
+
+            self._admitted -= 1
+
+        if self.closed:
+            return
+
+        self.chunks.append(chunk)
+        self._readable.set()
+        self._admit()
+
+    async def get(self) -> Dict:
+        while not self.chunks:
+            self._readable.clear()
+            await self._readable.wait()
+
+        chunk = self.chunks.popleft()
+        self._admit()
+
+        return chunk
+
+    def close(self):
+        """Drop all chunks and release held handlers."""
+
+        self.closed = True
+        self.chunks.clear()
+
+        while self._writers:
+            self._admitted += 1
+            self._writers.popleft().set_result(None)
+
+    def _full(self) -> bool:
+        return len(self.chunks) + self._admitted >= self.size
+
+    def _admit(self):
+        """Let held handlers through while there is room for their chunks."""
+
+        while self._writers and not self._full():
+            self._admitted += 1
+            self._writers.popleft().set_result(None)
 
 
 class Pool:
     """Allows for waiting for mqtt responses."""
 
-    def __init__(self, mqtt: FastMQTT):
+    # Shared response topics for multiplexed connectors, subscribed once on connect.
+    # The last level is the correlation id (the uuid level of the request topic).
+    RESPONSE_TOPICS = ("moca/response/+", "moca/keepalive/+", "moca/chunk/+/+")
+
+    def __init__(self, mqtt: FastMQTT, multiplexed: Iterable[str] = ()):
         self.mqtt = mqtt
-        self.pool = {}
-        self.topics = {}
 
-    async def get(self, topic: str, payload: Dict, timeout: int = 10):
-        """Get the response for the topic."""
+        # connector types that answer on the shared response topics
+        self.multiplexed = set(multiplexed)
 
-        # Handle topic
-        self.topics[topic] = 0
-        self.pool[topic] = Queue()
+        # correlation id -> topic, for requests to multiplexed connectors
+        self.correlations: Dict[str, str] = {}
 
-        # Subscribe to response topic
-        self.mqtt.client.subscribe(f"{topic}/response")
-        self.mqtt.client.subscribe(f"{topic}/keepalive")
+        # topic -> future (single response) or chunk buffer (chunked response)
+        self.pool: Dict[str, Union[asyncio.Future, ChunkBuffer]] = {}
 
-        # Publish data
-        await self.mqtt.publish(topic, json.dumps(payload))
+        # topic -> timeout in seconds, restarted by keepalives and chunks
+        self.timeouts: Dict[str, float] = {}
 
-        # Wait for response (with timeout and keepalive)
-        while True:
-            try:
-                response = self.pool.get(topic).get_nowait()
+        # topic -> event loop time at which the request times out
+        self.deadlines: Dict[str, float] = {}
 
-                # Unsubscribe
-                await self.mqtt.unsubscribe(f"{topic}/response")
-                await self.mqtt.unsubscribe(f"{topic}/keepalive")
+        # (topic without the correlation id, payload) -> shared request
+        self.flights: Dict[Tuple[str, str], asyncio.Future] = {}
 
-                del self.topics[topic]
+        # Requests that were answered by a shared request
+        self.coalesced = 0
 
-                # Return response
-                return response
+    async def get(
+        self, topic: str, payload: Dict, timeout: int = 10, shared: bool = False
+    ):
+        """Get the response for the topic.
 
-            except Empty:
-                pass
+        With `shared`, callers asking for the same command with the same payload
+        at the same time share one request and its response, which they must not
+        modify. Only use it for commands without side effects."""
 
-            if self.topics[topic] > timeout:
-                raise HTTPException(
-                    status_code=HTTP_504_GATEWAY_TIMEOUT,
-                    detail="A connected server did not answer in time.",
-                )
+        if shared:
+            return await self._single_flight(
+                topic, payload, lambda: self.get(topic, payload, timeout)
+            )
 
-            await asyncio.sleep(0.1)
-            self.topics[topic] += 0.1
+        response = asyncio.get_event_loop().create_future()
+
+        try:
+            await self._request(topic, payload, response, timeout)
+            return await self._wait(topic, response)
+        finally:
+            await self._release(topic)
 
     async def get_bytes(
-        self, topic: str, payload: Dict, timeout: int = 30
+        self, topic: str, payload: Dict, timeout: int = 30, shared: bool = False
     ) -> Tuple[str, str, bytes]:
-        """Get filename, mime type and bytes for the topic."""
+        """Get filename, mime type and bytes for the topic. See get for `shared`."""
+
+        response, data = await self._receive(topic, payload, timeout, shared)
+
+        return response.get("filename"), response.get("mime"), data
+
+    async def get_range(
+        self, topic: str, payload: Dict, timeout: int = 30, shared: bool = False
+    ) -> Tuple[str, str, bytes, Optional[int]]:
+        """Get filename, mime type, bytes and total size of the file for the topic.
+        The size is only sent by services that answered with a part of the file.
+        See get for `shared`."""
+
+        response, data = await self._receive(topic, payload, timeout, shared)
+
+        return (
+            response.get("filename"),
+            response.get("mime"),
+            data,
+            response.get("size"),
+        )
+
+    async def _receive(
+        self, topic: str, payload: Dict, timeout: int, shared: bool = False
+    ) -> Tuple[Dict, bytes]:
+        """Get the final response and the joined chunks for the topic."""
+
+        if shared:
+            return await self._single_flight(
+                topic, payload, lambda: self._receive(topic, payload, timeout)
+            )
+
+        chunks = ChunkBuffer()
+
+        # (sequence number, bytes), joined once the last chunk arrived
+        received = []
+
+        try:
+            await self._request(topic, payload, chunks, timeout)
+
+            while True:
+                response = await self._wait(topic, asyncio.ensure_future(chunks.get()))
+
+                if not response.get("data"):
+                    break
+
+                received.append(
+                    (response.get("seq", len(received)), decode_chunk(response))
+                )
+        finally:
+            await self._release(topic)
+
+        if response.get("chunks", len(received)) != len(received):
+            raise HTTPException(
+                status_code=HTTP_502_BAD_GATEWAY,
+                detail="A connected server did not send the complete file.",
+            )
+
+        received.sort(key=itemgetter(0))
+
+        return response, b"".join(data for _, data in received)
+
+    async def get_stream(
+        self,
+        topic: str,
+        payload: Dict,
+        timeout: int = 30,
+        buffer_size: int = STREAM_BUFFER_SIZE,
+    ) -> Tuple[Optional[str], Optional[str], Optional[AsyncIterator[bytes]]]:
+        """Get filename, mime type and an iterator over the bytes for the topic.
+        Returns as soon as the first chunk arrived, so filename and mime type are
+        only known if the service sends them with the first chunk.
+        The iterator is None if the service did not send any data."""
+
+        chunks = ChunkBuffer(buffer_size)
+
+        try:
+            await self._request(topic, payload, chunks, timeout)
+            first = await self._wait(topic, asyncio.ensure_future(chunks.get()))
+        except BaseException:
+            await self._release(topic)
+            raise
+
+        if not first.get("data"):
+            await self._release(topic)
+            return first.get("filename"), first.get("mime"), None
+
+        async def stream():
+            try:
+                response = first
+                position = 0
+
+                while response.get("data"):
+                    if response.get("seq", position) != position:
+                        raise HTTPException(
+                            status_code=HTTP_502_BAD_GATEWAY,
+                            detail="A connected server did not send the complete file.",
+                        )
+
+                    yield decode_chunk(response)
+                    position += 1
+
+                    # The timeout only counts while waiting for the service
+                    self._extend(topic)
+                    response = await self._wait(
+                        topic, asyncio.ensure_future(chunks.get())
+                    )
+            finally:
+                await self._release(topic)
+
+        return first.get("filename"), first.get("mime"), stream()
+
+    def stats(self) -> Dict:
+        return {
+            "pending": len(self.pool),
+            "shared": len(self.flights),
+            "coalesced": self.coalesced,
+        }
+
+    async def _single_flight(
+        self, topic: str, payload: Dict, request: Callable[[], Awaitable]
+    ):
+        """Start the request, or wait for an identical one that is in flight.
+        A caller that is cancelled does not cancel the request for the others."""
+
+        # {connector_type}/{connector_id}/{correlation_id}/{command...}
+        parts = topic.split("/")
+        key = ("/".join(parts[:2] + parts[3:]), json.dumps(payload, sort_keys=True))
+        flight = self.flights.get(key)
+
+        if flight is None:
+            flight = self.flights[key] = asyncio.ensure_future(request())
+
+            def land(future: asyncio.Future):
+                if self.flights.get(key) is future:
+                    del self.flights[key]
+
+                # Retrieve the exception, in case all callers were cancelled
+                if not future.cancelled():
+                    future.exception()
+
+            flight.add_done_callback(land)
+        else:
+            self.coalesced += 1
+
+        return await asyncio.shield(flight)
+
+    async def handle(self, topic: str, payload: bytes) -> bool:
+        """Handle an incoming mqtt message.
+        Returns False if the topic is not a response topic."""
+
+        parts = topic.split("/")
+
+        if (
+            len(parts) in (3, 4)
+            and parts[0] == "moca"
+            and parts[1] in ("response", "keepalive", "chunk")
+        ):
+            # moca/response/{correlation_id}, moca/keepalive/{correlation_id}
+            # or moca/chunk/{correlation_id}/{seq}
+            real_topic = self.correlations.get(parts[2])
+
+            if real_topic is None:
+                return True
+
+            parts = real_topic.split("/") + parts[1:2] + parts[3:]
+
+        if parts[-1] == "response":
+            real_topic = "/".join(parts[:-1])
+
+            if real_topic in self.pool:
+                await self._deliver(real_topic, json.loads(payload.decode()))
+
+        elif parts[-1] == "keepalive":
+            self._extend("/".join(parts[:-1]))
+
+        elif len(parts) > 1 and parts[-2] == "chunk" and parts[-1].isdigit():
+            # Raw chunk: the payload are the bytes, the sequence number is in the topic
+            real_topic = "/".join(parts[:-2])
+
+            if payload and isinstance(self.pool.get(real_topic), ChunkBuffer):
+                await self._deliver(
+                    real_topic, {"data": payload, "seq": int(parts[-1])}
+                )
+
+        else:
+            return False
+
+        return True
+
+    async def _deliver(self, topic: str, response: Dict):
+        """Pass a response to the waiter of the topic."""
+
+        waiter = self.pool.get(topic)
+
+        if isinstance(waiter, ChunkBuffer):
+            self._extend(topic)
+            await waiter.put(response)
+        elif waiter is not None and not waiter.done():
+            waiter.set_result(response)
 
-        # Handle topic
-        self.topics[topic] = 0
-        self.pool[topic] = Queue()
+    async def _request(self, topic: str, payload: Dict, waiter, timeout: int):
+        """Register a waiter for the topic and publish the request.
+        The caller releases the topic, also if publishing fails."""
 
-        # Subscribe to response topic
-        self.mqtt.client.subscribe(f"{topic}/response")
-        self.mqtt.client.subscribe(f"{topic}/keepalive")
+        self.pool[topic] = waiter
+        self.timeouts[topic] = timeout
+        self._extend(topic)
+
+        connector_type, _, correlation_id = topic.split("/")[:3]
+
+        if connector_type in self.multiplexed:
+            # Answered on the shared response topics
+            self.correlations[correlation_id] = topic
+        else:
+            # Subscribe to response topic
+            self.mqtt.client.subscribe(f"{topic}/response")
+            self.mqtt.client.subscribe(f"{topic}/keepalive")
+
+            if isinstance(waiter, ChunkBuffer):
+                self.mqtt.client.subscribe(f"{topic}/chunk/+")
 
         # Publish data
         await self.mqtt.publish(topic, json.dumps(payload))
 
-        # Wait for response (with timeout and keepalive)
+    async def _wait(self, topic: str, future: asyncio.Future):
+        """Wait for the future until the deadline of the topic has passed.
+        Keepalives move the deadline, so the remaining time is recalculated
+        every time the wait ends without a result."""
 
-        data = b""
+        loop = asyncio.get_event_loop()
 
-        while True:
-            try:
-                response = self.pool.get(topic).get_nowait()
+        try:
+            while True:
+                remaining = self.deadlines[topic] - loop.time()
 
-                if not response.get("data"):
+                if remaining <= 0:
+                    raise HTTPException(
+                        status_code=HTTP_504_GATEWAY_TIMEOUT,
+                        detail="A connected server did not answer in time.",
+                    )
 
-                    # Unsubscribe
-                    await self.mqtt.unsubscribe(f"{topic}/response")
-                    await self.mqtt.unsubscribe(f"{topic}/keepalive")
+                done, _ = await asyncio.wait({future}, timeout=remaining)
 
-                    del self.topics[topic]
+                if done:
+                    return future.result()
+        finally:
+            if not future.done():
+                future.cancel()
 
-                    # Return response
-                    return response.get("filename"), response.get("mime"), data
+    def _extend(self, topic: str):
+        """Restart the timeout of the topic."""
 
-                else:
-                    data = data + base64.b64decode(response.get("data").encode())
-                    self.topics[topic] = 0
+        if topic in self.pool:
+            self.deadlines[topic] = (
+                asyncio.get_event_loop().time() + self.timeouts[topic]
+            )
 
-            except Empty:
-                pass
+    async def _release(self, topic: str):
+        """Forget the topic and unsubscribe from its responses."""
 
-            if self.topics[topic] > timeout:
-                raise HTTPException(
-                    status_code=HTTP_504_GATEWAY_TIMEOUT,
-                    detail="A connected server did not answer in time.",
-                )
+        waiter = self.pool.pop(topic, None)
+        self.timeouts.pop(topic, None)
+        self.deadlines.pop(topic, None)
 
-            await asyncio.sleep(0.1)
-            self.topics[topic] += 0.1
+        if isinstance(waiter, ChunkBuffer):
+            waiter.close()
 
-    def handle(self, topic: str, payload: Dict):
-        """Handle an incoming mqtt message."""
+        if self.correlations.pop(topic.split("/")[2], None) is not None:
+            return
 
-        if topic.endswith("/response"):
-            real_topic = topic[:-9]
-            if real_topic in self.topics.keys():
-                self.pool[real_topic].put(payload)
+        # Unsubscribe
+        await self.mqtt.unsubscribe(f"{topic}/response")
+        await self.mqtt.unsubscribe(f"{topic}/keepalive")
 
-        elif topic.endswith("/keepalive"):
-            real_topic = topic[:-10]
-            if real_topic in self.topics.keys():
-                self.topics[real_topic] = 0
+        if isinstance(waiter, ChunkBuffer):
+            await self.mqtt.unsubscribe(f"{topic}/chunk/+")
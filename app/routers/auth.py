@@ -3,7 +3,8 @@ from starlette.responses import Response
 from app import crud, models
 from datetime import datetime, timedelta
 from fastapi.exceptions import HTTPException
-from sqlalchemy.orm.session import Session
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.dependencies import (
     ACCESS_TOKEN_EXPIRE_DAYS,
     authenticate_user,
@@ -11,11 +12,11 @@ from app.dependencies import (
     get_current_verified_user,
     get_db,
     get_hashed_password,
+    session_cache,
 )
 from fastapi import APIRouter, status
 from fastapi.params import Depends
 from fastapi.security import OAuth2PasswordRequestForm
-from setuptools_scm import get_version
 from app.schemas import (
     AuthUser,
     Info,
@@ -33,11 +34,13 @@ async def login(
     form_data: OAuth2PasswordRequestForm = Depends(),
     user_agent=Header(None),
     x_moca_client=Header(None),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """Login to the MOCA Server.
     This will return an access token which can be used to authenticate all following requests."""
-    user: models.User = authenticate_user(form_data.username, form_data.password, db)
+    user: models.User = await authenticate_user(
+        form_data.username, form_data.password, db
+    )
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -52,7 +55,7 @@ async def login(
         valid_until=datetime.now() + timedelta(days=30),
     )
     db.add(new_session) # add is ok here
-    db.commit()
+    await db.commit()
 
     access_token_expires = timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS)
     access_token = create_access_token(
@@ -68,19 +71,20 @@ async def login(
 
 @router.post("/refresh", response_model=Token)
 async def refresh(
-    user: AuthUser = Depends(get_current_verified_user), db: Session = Depends(get_db)
+    user: AuthUser = Depends(get_current_verified_user),
+    db: AsyncSession = Depends(get_db),
 ):
     """Get a refresh token.
     Generating a refresh token will instantly invalidate all previous refresh tokens."""
 
-    current_session = (
-        db.query(models.Session)
-        .filter(models.Session.session_id == user.session_id)
-        .first()
+    result = await db.execute(
+        select(models.Session).filter(models.Session.session_id == user.session_id)
     )
+    current_session = result.scalars().first()
     current_session.valid_until = datetime.now() + timedelta(days=30)
 
-    db.commit()
+    await db.commit()
+    await session_cache.invalidate_session(user.session_id)
 
     access_token_expires = timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS)
     access_token = create_access_token(
@@ -96,33 +100,40 @@ async def refresh(
 
 @router.post("/logout", status_code=status.HTTP_204_NO_CONTENT, response_class=Response)
 async def logout(
-    user: AuthUser = Depends(get_current_verified_user), db: Session = Depends(get_db)
+    user: AuthUser = Depends(get_current_verified_user),
+    db: AsyncSession = Depends(get_db),
 ):
     """Logout from the current session."""
 
-    db.query(models.Session).filter(
-        models.Session.session_id == user.session_id
-    ).delete()
-    db.commit()
+    await db.execute(
+        delete(models.Session).filter(models.Session.session_id == user.session_id)
+    )
+    await db.commit()
+    await session_cache.invalidate_session(user.session_id)
 
 
 @router.post("/register", response_model=UserResponse)
 async def register_user(
-    register_request: RegisterRequest, db: Session = Depends(get_db)
+    register_request: RegisterRequest, db: AsyncSession = Depends(get_db)
 ):
     """Register a new user.
     The user will have to verify their account via /auth/verify."""
-    db_user = crud.get_user_by_username(db, username=register_request.username)
+    db_user = await crud.get_user_by_username(db, username=register_request.username)
     if db_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="A user with this username is already registered",
         )
-    return crud.create_user(db=db, user=register_request)
+    return await crud.create_user(db=db, user=register_request)
 
 
 @router.post("/verify")
-async def verify_user(verify_request: VerifyRequest, db: Session = Depends(get_db)):
+async def verify_user(
+    verify_request: VerifyRequest, db: AsyncSession = Depends(get_db)
+):
     """Verify a user.
     After verification, the user can login via /auth/login."""
-    return crud.verify_user(db, verify_request)
+    user = await crud.verify_user(db, verify_request)
+    await session_cache.invalidate_user(user.user_id)
+
+    return user
@@ -1,7 +1,6 @@
 from datetime import datetime
 import json
 from os import name
-from sqlalchemy.sql.functions import func
 from sqlalchemy.sql.operators import desc_op
 from starlette.responses import Response
 from app import models
@@ -11,13 +10,16 @@ from typing import List
 from fastapi.exceptions import HTTPException
 from starlette.routing import request_response
 from app import crud
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.dependencies import (
     get_current_user,
     get_current_verified_user,
     get_db,
+    get_events,
     get_pagination,
 )
+from app.events import EventBus, chat_deleted_event, chat_event
 from fastapi.param_functions import Depends
 from app.schemas import (
     ChatDetailsResponse,
@@ -39,65 +41,73 @@ router = APIRouter(prefix="/chats", tags=["chats"])
 async def get_chats(
     pagination: Pagination = Depends(get_pagination),
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """Get a list of all chats the user has."""
 
-    chats_with_message = (
-        db.query(
-            models.Chat,
-            models.Connector,
-            models.Message,
-            func.max(models.Message.sent_datetime),
-        )
+    # Chats with messages, most recently active first.
+    # Only the last messages of the chats on the page are read.
+    result = await db.execute(
+        select(models.Chat, models.Message)
+        .join(models.Message, models.Message.message_id == models.Chat.last_message_id)
+        # Chats of connectors that were deleted before their chats were deleted
+        # with them are left out
         .join(models.Connector)
-        .join(models.Message)
-        .group_by(models.Message.chat_id)
-        .filter(models.Connector.user_id == current_user.user_id)
-        .order_by(desc_op(models.Message.sent_datetime))
+        .filter(models.Chat.user_id == current_user.user_id)
+        .order_by(desc_op(models.Chat.last_activity_at))
         .limit(pagination.count)
         .offset(pagination.page * pagination.count)
-        .all()
     )
+    chats_with_message = result.all()
 
     if not chats_with_message:
         return []
 
     return [
         ChatResponse(
-            chat_id=chat_with_message[0].chat_id,
-            connector_id=chat_with_message[0].connector_id,
-            name=chat_with_message[0].name,
-            is_muted=chat_with_message[0].is_muted,
-            is_archived=chat_with_message[0].is_archived,
-            pin_position=chat_with_message[0].pin_position,
+            chat_id=chat.chat_id,
+            connector_id=chat.connector_id,
+            name=chat.name,
+            is_muted=chat.is_muted,
+            is_archived=chat.is_archived,
+            pin_position=chat.pin_position,
             last_message=schemas.MessageResponse(
-                message_id=chat_with_message[2].message_id,
-                contact_id=chat_with_message[2].contact_id,
-                message=json.loads(chat_with_message[2].message),
-                sent_datetime=chat_with_message[2].sent_datetime,
+                message_id=last_message.message_id,
+                contact_id=last_message.contact_id,
+                message=json.loads(last_message.message),
+                sent_datetime=last_message.sent_datetime,
             )
-            if chat_with_message[2]
+            if last_message
             else None,
         )
-        for chat_with_message in chats_with_message
+        for chat, last_message in chats_with_message
     ]
 
 @router.get("/{chat_id}", response_model=ChatDetailsResponse)
 async def get_chat(
     chat_id: int,
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """Get a detailed chat object. Contains information about the participants of the chat."""
 
-    chat = db.query(Chat).filter(Chat.chat_id == chat_id).first()
+    chat = await crud.get_chat(db, current_user.user_id, chat_id)
 
-    contacts = []
+    if not chat:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"The chat with id {chat_id} does not exist.",
+        )
 
-    for rel in chat.contacts:
+    result = await db.execute(
+        select(models.Contact)
+        .join(models.ContactsChatsRelationship)
+        .filter(models.ContactsChatsRelationship.chat_id == chat_id)
+    )
 
-        contact = crud.get_contact(db, current_user.user_id, rel.contact_id)
+    contacts = []
+
+    for contact in result.scalars():
         contacts.append(ContactResponse(
             contact_id=contact.contact_id,
             connector_id=contact.connector_id,
@@ -124,12 +134,23 @@ async def get_chat(
 async def delete_chat(
     chat_id: int,
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
+    events: EventBus = Depends(get_events),
 ):
     """Deletes a chat and all its messages. This action cannot be undone."""
 
-    db.query(Chat).filter(Chat.chat_id == chat_id).delete()
-    db.commit()
+    chat: Chat = await crud.get_chat(db, current_user.user_id, chat_id)
+
+    if not chat:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"The chat with id {chat_id} does not exist.",
+        )
+
+    await crud.record_chats_deleted(db, current_user.user_id, [chat_id])
+    await db.execute(delete(Chat).filter(Chat.chat_id == chat_id))
+    await db.commit()
+    await events.publish(current_user.user_id, chat_deleted_event(chat_id))
 
 
 @router.post(
@@ -138,11 +159,12 @@ async def delete_chat(
 async def mute_chat(
     chat_id: int,
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
+    events: EventBus = Depends(get_events),
 ):
     """Mute a chat."""
 
-    chat: Chat = crud.get_chat(db, current_user.user_id, chat_id)
+    chat: Chat = await crud.get_chat(db, current_user.user_id, chat_id)
 
     if not chat:
         raise HTTPException(
@@ -151,7 +173,9 @@ async def mute_chat(
         )
 
     chat.is_muted = True
-    db.commit()
+    await crud.record_changes(db, current_user.user_id, "chat", [chat_id])
+    await db.commit()
+    await events.publish(current_user.user_id, chat_event(chat_id, "is_muted"))
 
 
 @router.delete(
@@ -160,11 +184,12 @@ async def mute_chat(
 async def unmute_chat(
     chat_id: int,
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
+    events: EventBus = Depends(get_events),
 ):
     """Unmute a chat."""
 
-    chat: Chat = crud.get_chat(db, current_user.user_id, chat_id)
+    chat: Chat = await crud.get_chat(db, current_user.user_id, chat_id)
 
     if not chat:
         raise HTTPException(
@@ -173,7 +198,9 @@ async def unmute_chat(
         )
 
     chat.is_muted = False
-    db.commit()
+    await crud.record_changes(db, current_user.user_id, "chat", [chat_id])
+    await db.commit()
+    await events.publish(current_user.user_id, chat_event(chat_id, "is_muted"))
 
 
 @router.post(
@@ -184,11 +211,12 @@ async def unmute_chat(
 async def archive_chat(
     chat_id: int,
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
+    events: EventBus = Depends(get_events),
 ):
     """Archive a chat."""
 
-    chat: Chat = crud.get_chat(db, current_user.user_id, chat_id)
+    chat: Chat = await crud.get_chat(db, current_user.user_id, chat_id)
 
     if not chat:
         raise HTTPException(
@@ -197,7 +225,9 @@ async def archive_chat(
         )
 
     chat.is_archived = True
-    db.commit()
+    await crud.record_changes(db, current_user.user_id, "chat", [chat_id])
+    await db.commit()
+    await events.publish(current_user.user_id, chat_event(chat_id, "is_archived"))
 
 
 @router.delete(
@@ -208,11 +238,12 @@ async def archive_chat(
 async def unarchive_chat(
     chat_id: int,
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
+    events: EventBus = Depends(get_events),
 ):
     """Unarchive a chat."""
 
-    chat: Chat = crud.get_chat(db, current_user.user_id, chat_id)
+    chat: Chat = await crud.get_chat(db, current_user.user_id, chat_id)
 
     if not chat:
         raise HTTPException(
@@ -221,7 +252,9 @@ async def unarchive_chat(
         )
 
     chat.is_archived = False
-    db.commit()
+    await crud.record_changes(db, current_user.user_id, "chat", [chat_id])
+    await db.commit()
+    await events.publish(current_user.user_id, chat_event(chat_id, "is_archived"))
 
 
 @router.put(
@@ -231,11 +264,12 @@ async def pin_chat(
     chat_id: int,
     pin: Pin,
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
+    events: EventBus = Depends(get_events),
 ):
     """Pin a chat."""
 
-    chat: Chat = crud.get_chat(db, current_user.user_id, chat_id)
+    chat: Chat = await crud.get_chat(db, current_user.user_id, chat_id)
 
     if not chat:
         raise HTTPException(
@@ -244,7 +278,9 @@ async def pin_chat(
         )
 
     chat.pin_position = pin.pin_position
-    db.commit()
+    await crud.record_changes(db, current_user.user_id, "chat", [chat_id])
+    await db.commit()
+    await events.publish(current_user.user_id, chat_event(chat_id, "pin_position"))
 
 
 @router.delete(
@@ -253,11 +289,12 @@ async def pin_chat(
 async def unpin_chat(
     chat_id: int,
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
+    events: EventBus = Depends(get_events),
 ):
     """Unpin a chat."""
 
-    chat: Chat = crud.get_chat(db, current_user.user_id, chat_id)
+    chat: Chat = await crud.get_chat(db, current_user.user_id, chat_id)
 
     if not chat:
         raise HTTPException(
@@ -266,4 +303,6 @@ async def unpin_chat(
         )
 
     chat.pin_position = None
-    db.commit()
+    await crud.record_changes(db, current_user.user_id, "chat", [chat_id])
+    await db.commit()
+    await events.publish(current_user.user_id, chat_event(chat_id, "pin_position"))
@@ -8,7 +8,8 @@ from typing import Dict, List, Optional
 from fastapi.exceptions import HTTPException
 from starlette.routing import request_response
 from app import crud
-from sqlalchemy.orm import Session
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.dependencies import (
     get_current_user,
     get_current_verified_user,
@@ -33,15 +34,16 @@ router = APIRouter(prefix="/connectors", tags=["connectors"])
 @router.get("", response_model=List[ConnectorResponse])
 async def get_connectors(
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """Get a list of all connectors the user has."""
 
-    connectors = (
-        db.query(models.Connector)
-        .filter(models.Connector.user_id == current_user.user_id)
-        .all()
+    result = await db.execute(
+        select(models.Connector).filter(
+            models.Connector.user_id == current_user.user_id
+        )
     )
+    connectors = result.scalars().all()
 
     if not connectors:
         return []
@@ -53,17 +55,17 @@ async def get_connectors(
 async def get_connector(
     connector_id: int,
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """Get a connector by id."""
-    return crud.get_connector(db, current_user.user_id, connector_id)
+    return await crud.get_connector(db, current_user.user_id, connector_id)
 
 
 @router.post("", response_model=ConnectorResponse)
 async def initialize_connector(
     request: InitializeConnectorRequest,
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     pool: Pool = Depends(get_pool),
 ):
     """Get a connector id to start configuring a connector (via PUT /connectors/{connector_id})."""
@@ -73,7 +75,9 @@ async def initialize_connector(
         user_id=current_user.user_id,
     )
     db.add(new_connector) # add is ok here
-    db.commit()
+    await db.commit()
+
+    await crud.invalidate_connector(new_connector.connector_id)
 
     return new_connector
 
@@ -83,12 +87,12 @@ async def setup_connector(
     connector_id: int,
     request: Optional[Dict],
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     pool: Pool = Depends(get_pool),
 ):
     """Configure a connector."""
 
-    connector = crud.get_connector(db, current_user.user_id, connector_id)
+    connector = await crud.get_connector(db, current_user.user_id, connector_id)
 
     response = await pool.get(
         f"{connector.connector_type}/{connector_id}/{str(uuid.uuid4())}/configure",
@@ -100,12 +104,14 @@ async def setup_connector(
 
         # 2. Create contact if not already exists
 
-        if (
-            db.query(models.Contact)
-            .filter(models.Contact.internal_id == contact.get("contact_id"), models.Contact.connector_id == connector_id)
-            .count()
-            == 0
-        ):
+        result = await db.execute(
+            select(func.count(models.Contact.contact_id)).filter(
+                models.Contact.internal_id == contact.get("contact_id"),
+                models.Contact.connector_id == connector_id,
+            )
+        )
+
+        if result.scalar() == 0:
             new_contact = models.Contact(
                 contact_id=crud.get_id(connector.connector_id, contact.get("contact_id")),
                 internal_id=contact.get("contact_id"),
@@ -116,11 +122,17 @@ async def setup_connector(
                 connector_id=connector.connector_id,
                 is_self=True,
             )
-            db.merge(new_contact)
+            await db.merge(new_contact)
+            await crud.record_changes(
+                db, current_user.user_id, "contact", [new_contact.contact_id]
+            )
 
         # 3. Create connector
         connector.connector_user_id = contact.get("contact_id")
-        db.commit()
+        await db.commit()
+
+        await crud.invalidate_connector(connector_id)
+        await crud.invalidate_connector_contacts(connector_id)
 
     return response
 
@@ -131,12 +143,12 @@ async def setup_connector(
 async def delete_connector(
     connector_id: int,
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     pool: Pool = Depends(get_pool),
 ):
     """Delete a connector."""
 
-    connector = crud.get_connector(db, current_user.user_id, connector_id)
+    connector = await crud.get_connector(db, current_user.user_id, connector_id)
 
     response = await pool.get(
         f"{connector.connector_type}/{connector_id}/{str(uuid.uuid4())}/delete_connector",
@@ -144,7 +156,25 @@ async def delete_connector(
     )
 
     if response.get("success"):
-        db.query(models.Connector).filter(
-            models.Connector.connector_id == connector_id
-        ).delete()
-        db.commit()
+        # Its chats and contacts are deleted with it
+        result = await db.execute(
+            select(models.Chat.chat_id).filter(models.Chat.connector_id == connector_id)
+        )
+        await crud.record_chats_deleted(
+            db, current_user.user_id, result.scalars().all()
+        )
+
+        result = await db.execute(
+            select(models.Contact.contact_id).filter(
+                models.Contact.connector_id == connector_id
+            )
+        )
+        await crud.record_changes(
+            db, current_user.user_id, "contact", result.scalars().all(), deleted=True
+        )
+
+        await crud.delete_connector(db, connector_id)
+        await db.commit()
+
+        await crud.invalidate_connector(connector_id)
+        await crud.invalidate_connector_contacts(connector_id)
@@ -6,7 +6,8 @@ from typing import List
 from fastapi.exceptions import HTTPException
 from starlette.routing import request_response
 from app import crud
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.dependencies import (
     get_current_user,
     get_current_verified_user,
@@ -32,12 +33,12 @@ router = APIRouter(prefix="/contacts", tags=["contacts"])
 async def get_contacts(
     pagination: Pagination = Depends(get_pagination),
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """Get a list of all contacts the user has."""
 
-    contacts = (
-        db.query(models.Contact)
+    result = await db.execute(
+        select(models.Contact)
         .join(models.Connector)
         .filter(
             models.Connector.user_id == current_user.user_id,
@@ -46,8 +47,8 @@ async def get_contacts(
         .order_by(models.Contact.name)
         .limit(pagination.count)
         .offset(pagination.page * pagination.count)
-        .all()
     )
+    contacts = result.scalars().all()
 
     if not contacts:
         return []
@@ -59,7 +60,7 @@ async def get_contacts(
 async def get_contact(
     contact_id: int,
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """Get a contact by id."""
-    return crud.get_contact(db, current_user.user_id, contact_id)
+    return await crud.get_contact(db, current_user.user_id, contact_id)
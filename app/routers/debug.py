@@ -1,13 +1,21 @@
-from app import models
-from app.database import Base
+from app import crud, models
+from app.database import Base, async_engine
 import json
 from datetime import datetime, timedelta
+from app.startup import startup_report
 from app.models import Chat, Contact, Message, User, Connector, Session as SessionModel
-from app.dependencies import get_db, get_hashed_password
+from app.dependencies import (
+    get_db,
+    get_hashed_password,
+    events,
+    ingestion,
+    password_hasher,
+    pool,
+    session_cache,
+)
 from fastapi import APIRouter, HTTPException, status
 from fastapi import Depends
-from setuptools_scm import get_version
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 import secrets
 import os
@@ -31,29 +39,44 @@ def debug_login(credentials: HTTPBasicCredentials = Depends(security)):
         )
     return credentials.username
 
+
+async def reset_database():
+    """Drop and recreate all tables, and forget everything cached about them."""
+
+    async with async_engine.begin() as connection:
+        await connection.run_sync(Base.metadata.drop_all)
+        await connection.run_sync(Base.metadata.create_all)
+
+    crud.contact_id_cache.clear()
+    crud.connector_cache.clear()
+    session_cache.clear()
+
+
 @router.post("/clear")
-async def clear(db: Session = Depends(get_db), username: str = Depends(debug_login)):
+async def clear(
+    db: AsyncSession = Depends(get_db), username: str = Depends(debug_login)
+):
     """Clears the database."""
 
-    Base.metadata.drop_all()
-    Base.metadata.create_all()
+    await reset_database()
 
     return {}
 
 
 @router.post("/seed")
-async def seed(db: Session = Depends(get_db), username: str = Depends(debug_login)):
+async def seed(
+    db: AsyncSession = Depends(get_db), username: str = Depends(debug_login)
+):
     """Clears the database and fills it with demo data."""
 
-    Base.metadata.drop_all()
-    Base.metadata.create_all()
+    await reset_database()
 
     # Create Users
 
     new_user = User(
         username="jkahnwald",
         mail="jkahnwald@stadt-winden.de",
-        hashed_password=get_hashed_password("jkahnwald"),
+        hashed_password=await get_hashed_password("jkahnwald"),
         is_verified=True,
     )
     db.add(new_user)
@@ -61,7 +84,7 @@ async def seed(db: Session = Depends(get_db), username: str = Depends(debug_logi
     new_user = User(
         username="tomschneider",
         mail="tomschneider@stadt-winden.de",
-        hashed_password=get_hashed_password("tomschneider"),
+        hashed_password=await get_hashed_password("tomschneider"),
         is_verified=True,
     )
     db.add(new_user)
@@ -69,7 +92,7 @@ async def seed(db: Session = Depends(get_db), username: str = Depends(debug_logi
     new_user = User(
         username="nickschestag",
         mail="nickschestag@stadt-winden.de",
-        hashed_password=get_hashed_password("nickschestag"),
+        hashed_password=await get_hashed_password("nickschestag"),
         is_verified=True,
     )
     db.add(new_user)
@@ -86,7 +109,7 @@ async def seed(db: Session = Depends(get_db), username: str = Depends(debug_logi
 
     new_connector = Connector(connector_type="DEMO", user_id=1, connector_user_id="1")
     db.add(new_connector)
-    db.commit()
+    await db.commit()
 
     # Create Contacts
 
@@ -111,19 +134,20 @@ async def seed(db: Session = Depends(get_db), username: str = Depends(debug_logi
     )
     db.add(contact_mnielsen)
 
-    db.commit()
+    await db.commit()
 
     # Create Chats
 
     new_chat = Chat(
         connector_id=new_connector.connector_id,
+        user_id=new_connector.user_id,
         name="Windener Jugend",
         is_muted=False,
         is_archived=False,
     )
     db.add(new_chat)
 
-    db.commit()
+    await db.commit()
 
     db.add(
         models.ContactsChatsRelationship(
@@ -194,6 +218,39 @@ async def seed(db: Session = Depends(get_db), username: str = Depends(debug_logi
     db.add(msg4)
     db.add(msg5)
 
-    db.commit()
+    await db.flush()
+    await crud.refresh_last_message(db, new_chat.chat_id)
+    await crud.record_changes(
+        db,
+        new_connector.user_id,
+        "contact",
+        [contact_jkahnwald.contact_id, contact_mnielsen.contact_id],
+    )
+    await crud.record_changes(db, new_connector.user_id, "chat", [new_chat.chat_id])
+    await crud.record_changes(
+        db,
+        new_connector.user_id,
+        "message",
+        [msg.message_id for msg in (msg1, msg2, msg3, msg4, msg5)],
+    )
+    await db.commit()
 
     return {}
+
+
+@router.get("/stats")
+async def stats(username: str = Depends(debug_login)):
+    """Get statistics about the caches, the ingestion queue, the connector
+    requests, the events, the password hashing threads and the startup of this
+    worker."""
+
+    return {
+        "connector_cache": crud.connector_cache.stats(),
+        "contact_id_cache": crud.contact_id_cache.stats(),
+        "session_cache": session_cache.stats(),
+        "password_hasher": password_hasher.stats(),
+        "startup": startup_report.stats(),
+        "ingestion": ingestion.stats(),
+        "pool": pool.stats(),
+        "events": events.stats(),
+    }
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import logging
+from typing import Dict, Optional
+
+from fastapi import APIRouter, HTTPException, Query, WebSocket, status
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import crud, models
+from app.database import AsyncSessionLocal
+from app.dependencies import authenticate_token, events
+from app.events import CHAT_EVENT_FIELDS
+from app.schemas import MessageResponse
+
+_LOGGER = logging.getLogger(__name__)
+
+# Websocket routes do not get the prefix of their router
+router = APIRouter(tags=["events"])
+
+
+async def load_event(db: AsyncSession, user_id: int, event: Dict) -> Optional[Dict]:
+    """The event as it is sent to clients, with the chat or messages it refers to
+    loaded. Events about chats the user does not have, and deletions of things
+    that still exist, are dropped (None), so events published by anyone else than
+    a server cannot reach the clients."""
+
+    if event["type"] == "resync":
+        return event
+
+    chat = await crud.get_chat(db, user_id, event["chat_id"])
+
+    if event["type"] == "chat_deleted":
+        return event if chat is None else None
+
+    if chat is None:
+        return None
+
+    if event["type"] == "chat":
+        return {
+            "type": "chat",
+            "chat_id": chat.chat_id,
+            **{
+                field: getattr(chat, field)
+                for field in event["fields"]
+                if field in CHAT_EVENT_FIELDS
+            },
+        }
+
+    if event["type"] == "message_deleted":
+        result = await db.execute(
+            select(models.Message.message_id).filter(
+                models.Message.chat_id == chat.chat_id,
+                models.Message.message_id == event["message_id"],
+            )
+        )
+        return event if result.first() is None else None
+
+    if event["type"] == "messages":
+        messages = None
+
+        if event["message_ids"] is not None:
+            result = await db.execute(
+                select(models.Message).filter(
+                    models.Message.chat_id == chat.chat_id,
+                    models.Message.message_id.in_(event["message_ids"]),
+                )
+            )
+            loaded = {message.message_id: message for message in result.scalars()}
+
+            # In the order of the event, without messages deleted since
+            messages = [
+                MessageResponse(
+                    message_id=message.message_id,
+                    contact_id=message.contact_id,
+                    sent_datetime=message.sent_datetime,
+                    message=crud.prepare_message(
+                        chat.chat_id, message.message_id, message.message
+                    ),
+                )
+                for message in (
+                    loaded.get(message_id) for message_id in event["message_ids"]
+                )
+                if message is not None
+            ]
+
+        return {
+            "type": "messages",
+            "chat_id": chat.chat_id,
+            "count": event["count"],
+            "messages": messages,
+        }
+
+    return None
+
+
+@router.websocket("/events")
+async def get_events(websocket: WebSocket, token: str = Query(...)):
+    """Stream the events of the user, as json text messages, instead of polling.
+    Browsers cannot set headers on websockets, so the access token is passed as
+    the query parameter `token`."""
+
+    # The session is closed before streaming, so open sockets hold no connections
+    try:
+        async with AsyncSessionLocal() as db:
+            user = await authenticate_token(token, db)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    if not user.is_verified:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+
+    with events.subscribe(user.user_id) as queue:
+
+        async def send():
+            while True:
+                payload = await queue.get()
+
+                try:
+                    async with AsyncSessionLocal() as db:
+                        event = await load_event(db, user.user_id, json.loads(payload))
+                except Exception:
+                    _LOGGER.warning(f"Could not load event {payload}.", exc_info=True)
+                    continue
+
+                if event is not None:
+                    await websocket.send_text(json.dumps(jsonable_encoder(event)))
+
+        sender = asyncio.ensure_future(send())
+
+        try:
+            # Clients do not send anything, this only waits for the disconnect
+            while (await websocket.receive())["type"] != "websocket.disconnect":
+                pass
+        finally:
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
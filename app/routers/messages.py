@@ -1,3 +1,4 @@
+import base64
 import uuid
 from datetime import datetime
 
@@ -5,22 +6,27 @@ import sqlalchemy
 from app.pool import Pool
 import json
 from sqlalchemy.sql.operators import desc_op
-from starlette.responses import Response
+from starlette.responses import Response, StreamingResponse
 from app import models
 from app.models import Chat
-from typing import List
+from typing import List, Optional, Tuple
 from fastapi.exceptions import HTTPException
 from starlette.routing import request_response
 from app import crud
-from sqlalchemy.orm import Session
+from app.media_cache import MediaCache
+from sqlalchemy import and_, delete, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.dependencies import (
     get_current_user,
     get_current_verified_user,
     get_db,
+    get_events,
+    get_media_cache,
     get_pagination,
     get_pool,
 )
-from fastapi.param_functions import Depends
+from app.events import EventBus, message_deleted_event, messages_event
+from fastapi.param_functions import Depends, Header
 from app.schemas import (
     ChatResponse,
     DeleteMessageRequest,
@@ -38,22 +44,108 @@ from fastapi import APIRouter, status
 
 router = APIRouter(prefix="/chats/{chat_id}/messages", tags=["messages"])
 
-def prepare_message(chat_id, message_id, message):
-    msg = json.loads(message)
-    if 'url' in msg:
-        msg["url"] = f"/chats/{chat_id}/messages/{message_id}/media"
-    return msg
+
+def parse_range(header: str) -> Optional[Tuple[Optional[int], Optional[int]]]:
+    """Parse a single byte range of a Range header.
+    Returns (start, end) with inclusive positions, as in the header:
+    "bytes=500-" is (500, None) and the suffix "bytes=-500" is (None, 500).
+    Returns None for anything else, so the whole file is sent."""
+
+    unit, _, ranges = header.partition("=")
+
+    if unit.strip() != "bytes" or "," in ranges:
+        return None
+
+    start, _, end = ranges.strip().partition("-")
+
+    try:
+        start = int(start) if start else None
+        end = int(end) if end else None
+    except ValueError:
+        return None
+
+    if start is None and end is None:
+        return None
+
+    if start is not None and end is not None and end < start:
+        return None
+
+    return start, end
+
+
+def resolve_range(
+    requested: Tuple[Optional[int], Optional[int]], size: int
+) -> Tuple[int, int]:
+    """Get the first and last position of a parsed byte range in a file of the given size."""
+
+    start, end = requested
+
+    if start is None:
+        first, last = max(size - end, 0), size - 1
+    else:
+        first, last = start, size - 1 if end is None else min(end, size - 1)
+
+    if first >= size or last < first:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail=f"The range is not satisfiable for a file of {size} bytes.",
+            headers={"content-range": f"bytes */{size}"},
+        )
+
+    return first, last
+
+
+def encode_cursor(message: models.Message) -> str:
+    """Get an opaque cursor for the position of a message in its chat."""
+
+    position = f"{message.sent_datetime.isoformat()}|{message.message_id}"
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Get sent_datetime and message_id of a cursor."""
+
+    try:
+        sent_datetime, _, message_id = (
+            base64.urlsafe_b64decode(cursor.encode()).decode().partition("|")
+        )
+        return datetime.fromisoformat(sent_datetime), int(message_id)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor."
+        )
+
+
+def range_headers(first: int, last: int, size: int):
+    return {
+        "accept-ranges": "bytes",
+        "content-range": f"bytes {first}-{last}/{size}",
+        "content-length": str(last - first + 1),
+    }
+
 
 @router.get("", response_model=List[MessageResponse])
 async def get_messages(
     chat_id: int,
+    response: Response,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
     pagination: Pagination = Depends(get_pagination),
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
-    """Get a list of all messages for a specific chat."""
+    """Get a list of all messages for a specific chat, newest first.
+    The X-Moca-Before and X-Moca-After response headers contain cursors for the
+    oldest and the newest message of the list. Pass them as before (older messages)
+    or after (newer messages) to get the next page. page is ignored if a cursor is given."""
 
-    chat = crud.get_chat(db, current_user.user_id, chat_id)
+    if before and after:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Only one of before and after can be given.",
+        )
+
+    chat = await crud.get_chat(db, current_user.user_id, chat_id)
 
     if not chat:
         raise HTTPException(
@@ -61,24 +153,53 @@ async def get_messages(
             detail=f"The chat with id {chat_id} does not exist.",
         )
 
-    messages = (
-        db.query(models.Message)
-        .filter(models.Message.chat_id == chat_id)
-        .order_by(desc_op(models.Message.sent_datetime))
-        .limit(pagination.count)
-        .offset(pagination.page * pagination.count)
-        .all()
-    )
+    statement = select(models.Message).filter(models.Message.chat_id == chat_id)
+    sent_datetime = models.Message.sent_datetime
+    message_id = models.Message.message_id
+
+    # Ordered by (sent_datetime, message_id). The comparison on sent_datetime alone
+    # lets the database start at the cursor in the index, instead of skipping rows.
+    if before:
+        cursor_sent_datetime, cursor_message_id = decode_cursor(before)
+        statement = statement.filter(
+            sent_datetime <= cursor_sent_datetime,
+            or_(sent_datetime < cursor_sent_datetime, message_id < cursor_message_id),
+        )
+    elif after:
+        cursor_sent_datetime, cursor_message_id = decode_cursor(after)
+        statement = statement.filter(
+            sent_datetime >= cursor_sent_datetime,
+            or_(sent_datetime > cursor_sent_datetime, message_id > cursor_message_id),
+        )
+    else:
+        statement = statement.offset(pagination.page * pagination.count)
+
+    if after:
+        # The messages right after the cursor, reversed below
+        statement = statement.order_by(sent_datetime, message_id)
+    else:
+        statement = statement.order_by(desc_op(sent_datetime), desc_op(message_id))
+
+    result = await db.execute(statement.limit(pagination.count))
+    messages = result.scalars().all()
 
     if not messages:
         return []
 
+    if after:
+        messages.reverse()
+
+    response.headers["x-moca-before"] = encode_cursor(messages[-1])
+    response.headers["x-moca-after"] = encode_cursor(messages[0])
+
     return [
         MessageResponse(
             message_id=message.message_id,
             contact_id=message.contact_id,
             sent_datetime=message.sent_datetime,
-            message=prepare_message(chat.chat_id, message.message_id, message.message),
+            message=crud.prepare_message(
+                chat.chat_id, message.message_id, message.message
+            ),
         )
         for message in messages
     ]
@@ -90,10 +211,11 @@ async def send_message(
     message: Message,
     pool: Pool = Depends(get_pool),
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
+    events: EventBus = Depends(get_events),
 ):
     """Send a message to a chat."""
-    chat = crud.get_chat(db, current_user.user_id, chat_id)
+    chat = await crud.get_chat(db, current_user.user_id, chat_id)
 
     if not chat:
         raise HTTPException(
@@ -101,8 +223,8 @@ async def send_message(
             detail=f"The chat with id {chat_id} does not exist.",
         )
 
-    connector_id = chat.contacts[0].contact.connector_id
-    connector = crud.get_connector(db, current_user.user_id, connector_id)
+    connector_id = chat.connector_id
+    connector = await crud.get_connector(db, current_user.user_id, connector_id)
 
     if connector.connector_type == "DEMO":
         new_message = models.Message(
@@ -112,7 +234,7 @@ async def send_message(
             sent_datetime=datetime.now(),
         )
         db.add(new_message) # add is ok here
-        db.commit()
+        await db.flush()
 
     else:
         sent = await pool.get(
@@ -121,7 +243,7 @@ async def send_message(
         )
 
         # This should never be null
-        contact = db.query(models.Contact).filter(models.Contact.connector_id == connector_id, models.Contact.is_self).first()
+        contact = await crud.get_self_contact(db, connector_id)
 
         new_message = models.Message(
             message_id=crud.get_message_id(connector.connector_id, sent.get("message_id"), chat_id),
@@ -133,18 +255,40 @@ async def send_message(
         )
 
         try:
-            db.merge(new_message)
-            db.commit()
+            await db.merge(new_message)
+            await db.flush()
         except sqlalchemy.exc.IntegrityError:
             # happens when the service sends the message already back to the server via push api
-            pass
+            await db.rollback()
+
+    await crud.update_last_messages(
+        db,
+        [
+            dict(
+                chat_id=chat_id,
+                message_id=new_message.message_id,
+                sent_datetime=new_message.sent_datetime,
+            )
+        ],
+    )
+    # The chat has a new last message
+    await crud.record_changes(db, current_user.user_id, "chat", [chat_id])
+    await crud.record_changes(
+        db, current_user.user_id, "message", [new_message.message_id]
+    )
+    await db.commit()
 
-    return MessageResponse(
+    sent_message = MessageResponse(
         message_id=new_message.message_id,
         contact_id=new_message.contact_id,
         sent_datetime=new_message.sent_datetime,
         message=message.message.__dict__,
     )
+    await events.publish(
+        current_user.user_id, messages_event(chat_id, [new_message.message_id])
+    )
+
+    return sent_message
 
 
 @router.delete(
@@ -155,14 +299,36 @@ async def delete_message(
     message_id: int,
     request: DeleteMessageRequest,
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
+    events: EventBus = Depends(get_events),
 ):
     """Delete a message.
     Not all services support message deletion."""
-    db.query(models.Message).filter(
-        models.Message.chat_id == chat_id, models.Message.message_id == message_id
-    ).delete()
-    db.commit()
+    chat = await crud.get_chat(db, current_user.user_id, chat_id)
+
+    if not chat:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"The chat with id {chat_id} does not exist.",
+        )
+
+    await db.execute(
+        delete(models.Message).filter(
+            models.Message.chat_id == chat_id, models.Message.message_id == message_id
+        )
+    )
+
+    if chat.last_message_id == message_id:
+        await crud.refresh_last_message(db, chat_id)
+        await crud.record_changes(db, current_user.user_id, "chat", [chat_id])
+
+    await crud.record_changes(
+        db, current_user.user_id, "message", [message_id], deleted=True
+    )
+    await db.commit()
+    await events.publish(
+        current_user.user_id, message_deleted_event(chat_id, message_id)
+    )
 
 
 @router.put(
@@ -173,33 +339,56 @@ async def edit_message(
     message_id: int,
     message: MessageContent,
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
+    events: EventBus = Depends(get_events),
 ):
     """Edit a message.
     Not all services support message editing."""
-    edit_message = (
-        db.query(models.Message)
-        .filter(
+    chat = await crud.get_chat(db, current_user.user_id, chat_id)
+
+    if not chat:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"The chat with id {chat_id} does not exist.",
+        )
+
+    result = await db.execute(
+        select(models.Message).filter(
             models.Message.chat_id == chat_id, models.Message.message_id == message_id
         )
-        .first()
     )
+    edit_message = result.scalars().first()
+
+    if not edit_message:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"The message with id {message_id} does not exist.",
+        )
 
     edit_message.message = json.dumps(message.__dict__)
-    db.commit()
+    await crud.record_changes(db, current_user.user_id, "message", [message_id])
+    await db.commit()
+
+    await events.publish(current_user.user_id, messages_event(chat_id, [message_id]))
 
 
 @router.get("/{message_id}/media", response_class=Response)
 async def download_media(
     chat_id: int,
     message_id: int,
+    stream: bool = False,
+    range_header: Optional[str] = Header(None, alias="range"),
+    if_none_match: Optional[str] = Header(None),
     current_user: UserResponse = Depends(get_current_verified_user),
     pool: Pool = Depends(get_pool),
-    db: Session = Depends(get_db),
+    media_cache: MediaCache = Depends(get_media_cache),
+    db: AsyncSession = Depends(get_db),
 ):
     """Download a media file.
-    Not all messages have a media file attached to it."""
-    chat = crud.get_chat(db, current_user.user_id, chat_id)
+    Not all messages have a media file attached to it.
+    With stream=true, the file is sent to the client while it is still being received from the service.
+    A single byte range can be requested with the Range header."""
+    chat = await crud.get_chat(db, current_user.user_id, chat_id)
 
     if not chat:
         raise HTTPException(
@@ -207,18 +396,113 @@ async def download_media(
             detail=f"The chat with id {chat_id} does not exist.",
         )
 
-    connector_id = chat.contacts[0].contact.connector_id
-    connector = crud.get_connector(db, current_user.user_id, connector_id)
+    result = await db.execute(
+        select(models.Message).filter(
+            models.Message.chat_id == chat_id, models.Message.message_id == message_id
+        )
+    )
+    message = result.scalars().first()
+
+    if not message:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"The message with id {message_id} does not exist.",
+        )
 
-    message = db.query(models.Message).filter(models.Message.message_id == message_id).first()
+    requested = parse_range(range_header) if range_header else None
+    cached = await media_cache.get(message_id)
+
+    if cached:
+        etag = f'"{cached.digest}"'
+        mime = cached.mime or "application/octet-stream"
+
+        if if_none_match and etag in [t.strip() for t in if_none_match.split(",")]:
+            cached.file.close()
+            return Response(
+                status_code=status.HTTP_304_NOT_MODIFIED, headers={"etag": etag}
+            )
+
+        # Sent from the opened file, which stays readable if it is evicted meanwhile
+        size = cached.stat.st_size
+
+        if requested:
+            try:
+                first, last = resolve_range(requested, size)
+            except HTTPException:
+                cached.file.close()
+                raise
+
+            return StreamingResponse(
+                media_cache.read(cached.file, first, last),
+                status_code=status.HTTP_206_PARTIAL_CONTENT,
+                media_type=mime,
+                headers={"etag": etag, **range_headers(first, last, size)},
+            )
+
+        return StreamingResponse(
+            media_cache.read(cached.file, 0, size - 1),
+            media_type=mime,
+            headers={
+                "etag": etag,
+                "accept-ranges": "bytes",
+                "content-length": str(size),
+            },
+        )
 
-    filename, mime, data = await pool.get_bytes(
-        f"{connector.connector_type}/{connector_id}/{uuid.uuid4()}/chats/{chat.internal_id}/messages/{message.internal_id}/get_media", {}
-    )
+    connector_id = chat.connector_id
+    connector = await crud.get_connector(db, current_user.user_id, connector_id)
 
-    if data:
+    topic = f"{connector.connector_type}/{connector_id}/{uuid.uuid4()}/chats/{chat.internal_id}/messages/{message.internal_id}/get_media"
 
-        return Response(data, media_type=mime)
+    data = None
+
+    if requested:
+        start, end = requested
+        filename, mime, data, size = await pool.get_range(
+            topic, {"range": {"start": start, "end": end}}, shared=True
+        )
+
+        if data and size is not None and size != len(data):
+            # The service only sent the requested range
+            first = size - len(data) if start is None else start
+
+            return Response(
+                data,
+                status_code=status.HTTP_206_PARTIAL_CONTENT,
+                media_type=mime,
+                headers=range_headers(first, first + len(data) - 1, size),
+            )
+
+    elif stream:
+        filename, mime, chunks = await pool.get_stream(topic, {})
+
+        if chunks:
+            return StreamingResponse(
+                media_cache.tee(message_id, filename, mime, chunks),
+                media_type=mime or "application/octet-stream",
+            )
+
+    else:
+        filename, mime, data = await pool.get_bytes(topic, {}, shared=True)
+
+    if data:
+        # The whole file was sent
+        cached = await media_cache.put(message_id, filename, mime, data)
+        etag = f'"{cached.digest}"'
+
+        if requested:
+            first, last = resolve_range(requested, len(data))
+
+            return Response(
+                data[first : last + 1],
+                status_code=status.HTTP_206_PARTIAL_CONTENT,
+                media_type=mime,
+                headers={"etag": etag, **range_headers(first, last, len(data))},
+            )
+
+        return Response(
+            data, media_type=mime, headers={"etag": etag, "accept-ranges": "bytes"}
+        )
 
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND,
@@ -6,8 +6,14 @@ from typing import List
 from fastapi.exceptions import HTTPException
 from starlette.routing import request_response
 from app import crud
-from sqlalchemy.orm import Session
-from app.dependencies import get_current_user, get_current_verified_user, get_db
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.dependencies import (
+    get_current_user,
+    get_current_verified_user,
+    get_db,
+    session_cache,
+)
 from fastapi.param_functions import Depends
 from app.schemas import (
     AuthUser,
@@ -32,18 +38,17 @@ SESSION_NOT_FOUND = HTTPException(
 @router.get("", response_model=List[SessionResponse])
 async def get_sessions(
     current_user: AuthUser = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """Get a list of all active sessions the user has."""
 
-    sessions = (
-        db.query(models.Session)
-        .filter(
+    result = await db.execute(
+        select(models.Session).filter(
             models.Session.user_id == current_user.user_id,
             models.Session.valid_until > datetime.now(),
         )
-        .all()
     )
+    sessions = result.scalars().all()
 
     if not sessions:
         return []
@@ -54,19 +59,18 @@ async def get_sessions(
 @router.get("/current", response_model=SessionResponse)
 async def get_session(
     current_user: AuthUser = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """Get the current session."""
 
-    session = (
-        db.query(models.Session)
-        .filter(
+    result = await db.execute(
+        select(models.Session).filter(
             models.Session.user_id == current_user.user_id,
             models.Session.session_id == current_user.session_id,
             models.Session.valid_until > datetime.now(),
         )
-        .first()
     )
+    session = result.scalars().first()
 
     return session
 
@@ -75,18 +79,17 @@ async def get_session(
 async def get_session(
     session_id: int,
     current_user: AuthUser = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """Get a session by id."""
 
-    session = (
-        db.query(models.Session)
-        .filter(
+    result = await db.execute(
+        select(models.Session).filter(
             models.Session.session_id == session_id,
             models.Session.valid_until > datetime.now(),
         )
-        .first()
     )
+    session = result.scalars().first()
 
     if not session:
         raise SESSION_NOT_FOUND
@@ -97,15 +100,20 @@ async def get_session(
 @router.delete("", status_code=status.HTTP_204_NO_CONTENT, response_class=Response)
 async def logout_all_but_this_session(
     current_user: AuthUser = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """Logout from all sessions (except the current one)."""
 
-    db.query(models.Session).filter(
-        models.Session.user_id == current_user.user_id,
-        models.Session.session_id != current_user.session_id,
-    ).delete()
-    db.commit()
+    await db.execute(
+        delete(models.Session).filter(
+            models.Session.user_id == current_user.user_id,
+            models.Session.session_id != current_user.session_id,
+        )
+    )
+    await db.commit()
+
+    # The current session is cached again on its next request
+    await session_cache.invalidate_user(current_user.user_id)
 
 
 @router.delete(
@@ -114,12 +122,15 @@ async def logout_all_but_this_session(
 async def logout_from_session(
     session_id: int,
     current_user: UserResponse = Depends(get_current_verified_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     """Logout from one session."""
 
-    db.query(models.Session).filter(
-        models.Session.user_id == current_user.user_id,
-        models.Session.session_id == session_id,
-    ).delete()
-    db.commit()
+    await db.execute(
+        delete(models.Session).filter(
+            models.Session.user_id == current_user.user_id,
+            models.Session.session_id == session_id,
+        )
+    )
+    await db.commit()
+    await session_cache.invalidate_session(session_id)
@@ -0,0 +1,95 @@
+from typing import Dict, List
+
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import crud, models
+from app.dependencies import get_current_verified_user, get_db
+from app.schemas import (
+    AuthUser,
+    ContactResponse,
+    SyncChat,
+    SyncDeleted,
+    SyncMessage,
+    SyncResponse,
+)
+
+router = APIRouter(prefix="/sync", tags=["sync"])
+
+KINDS = {"chat": models.Chat, "message": models.Message, "contact": models.Contact}
+
+
+@router.get("", response_model=SyncResponse)
+async def sync(
+    since: int = Query(0, description="The cursor of the last sync, or 0."),
+    count: int = Query(500, ge=1, le=5000),
+    current_user: AuthUser = Depends(get_current_verified_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """Get the chats, messages and contacts that changed or were deleted since
+    the last sync, instead of reloading all of them.
+    Objects that changed several times are only returned once, as they are now."""
+
+    result = await db.execute(
+        select(models.Change)
+        .filter(
+            models.Change.user_id == current_user.user_id,
+            models.Change.change_id > since,
+        )
+        .order_by(models.Change.change_id)
+        .limit(count + 1)
+    )
+    changes = result.scalars().all()
+
+    has_more = len(changes) > count
+    changes = changes[:count]
+
+    changed: Dict[str, List[int]] = {kind: [] for kind in KINDS}
+    deleted: Dict[str, List[int]] = {kind: [] for kind in KINDS}
+
+    for change in changes:
+        (deleted if change.deleted else changed)[change.kind].append(change.object_id)
+
+    # kind -> objects that still exist
+    objects = {}
+
+    for kind, model in KINDS.items():
+        objects[kind] = []
+        primary_key = model.__table__.primary_key.columns[0]
+        ids = changed[kind]
+
+        # Stay below the maximum number of query parameters
+        for i in range(0, len(ids), 500):
+            result = await db.execute(
+                select(model).filter(primary_key.in_(ids[i : i + 500]))
+            )
+            objects[kind].extend(result.scalars().all())
+
+        # In the order of their changes
+        order = {object_id: i for i, object_id in enumerate(ids)}
+        objects[kind].sort(key=lambda obj: order[getattr(obj, primary_key.key)])
+
+    return SyncResponse(
+        cursor=changes[-1].change_id if changes else since,
+        has_more=has_more,
+        chats=[SyncChat.from_orm(chat) for chat in objects["chat"]],
+        messages=[
+            SyncMessage(
+                chat_id=message.chat_id,
+                message_id=message.message_id,
+                contact_id=message.contact_id,
+                sent_datetime=message.sent_datetime,
+                message=crud.prepare_message(
+                    message.chat_id, message.message_id, message.message
+                ),
+            )
+            for message in objects["message"]
+        ],
+        contacts=[ContactResponse.from_orm(contact) for contact in objects["contact"]],
+        deleted=SyncDeleted(
+            chats=deleted["chat"],
+            messages=deleted["message"],
+            contacts=deleted["contact"],
+        ),
+    )
@@ -167,3 +167,30 @@ class SessionResponse(Session):
 class Pagination(BaseModel):
     page: int
     count: int
+
+
+class SyncChat(Chat):
+    chat_id: int
+
+
+class SyncMessage(MessageResponse):
+    chat_id: int
+
+
+class SyncDeleted(BaseModel):
+    chats: List[int]
+    messages: List[int]
+    contacts: List[int]
+
+
+class SyncResponse(BaseModel):
+    cursor: int = Field(
+        description="Pass this as `since` to get the changes after this response."
+    )
+    has_more: bool = Field(
+        description="True if there are more changes. Get them with the new cursor."
+    )
+    chats: List[SyncChat]
+    messages: List[SyncMessage]
+    contacts: List[ContactResponse]
+    deleted: SyncDeleted
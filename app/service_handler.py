@@ -1,23 +1,60 @@
+import asyncio
+import logging
 import uuid
 
-import sqlalchemy
+from app.events import EventBus, chat_event, messages_event
 from app.pool import Pool
 from datetime import datetime
 import json
 from app import crud, models
-from typing import Dict
-from sqlalchemy.orm.session import Session
-from app.database import SessionLocal
+from typing import Dict, Iterable, List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import AsyncSessionLocal
+
+_LOGGER = logging.getLogger(__name__)
+
+# Columns that are overwritten when a pushed row already exists.
+# Columns the user can change (e.g. is_muted) or that are set by the server (is_self) are kept.
+CONTACT_COLUMNS = [
+    "internal_id",
+    "service_id",
+    "name",
+    "username",
+    "phone",
+    "avatar",
+    "pushed_at",
+]
+CHAT_COLUMNS = ["internal_id", "name", "pushed_at"]
+MESSAGE_COLUMNS = ["internal_id", "contact_id", "message", "sent_datetime", "pushed_at"]
+
+# Maximum number of contact requests to a service that run at the same time
+CONTACT_REQUEST_CONCURRENCY = 8
+
+# Number of contacts requested at once from services that support get_contacts
+CONTACT_BATCH_SIZE = 100
 
 
 class ServiceHandler:
-    def __init__(self, pool: Pool):
+    def __init__(
+        self, pool: Pool, events: EventBus, batch_contact_connectors: Iterable[str] = ()
+    ):
         self.pool = pool
+        self.events = events
+
+        # connector types that answer get_contacts for a list of contact ids
+        self.batch_contact_connectors = set(batch_contact_connectors)
 
-    async def handle(self, topic: str, payload: Dict):
-        db = SessionLocal()
+    async def handle(
+        self, topic: str, payload: Dict, pushed_at: Optional[datetime] = None
+    ):
+        """Write pushed data. Pushes of one connector can be handled by several
+        server workers at the same time, so a row is only updated if it was not
+        written from a push that reached the server later (pushed_at, in UTC)."""
 
-        try:
+        if pushed_at is None:
+            pushed_at = datetime.utcnow()
+
+        async with AsyncSessionLocal() as db:
             parts = topic.split("/")
 
             if len(parts) < 2 or parts[0] != "moca":
@@ -33,228 +70,414 @@ class ServiceHandler:
                 connector_id: int = int(parts[3])
                 command: str = parts[4]
 
-                connector = crud.get_connector_by_connector_id(
+                connector = await crud.get_connector_by_connector_id(
                     db, service, connector_id
                 )
 
                 if not connector:
                     return
 
+                # Each payload is written in one transaction, after all
+                # unknown contacts have been requested from the service.
+
                 if command == "contacts":
-                    for contact_data in payload:
-                        internal_contact_id = contact_data.get("contact_id")
-
-                        contact = models.Contact(
-                            contact_id=crud.get_id(
-                                connector.connector_id, internal_contact_id
-                            ),
-                            internal_id=internal_contact_id,
-                            service_id=service,
-                            name=contact_data.get("name"),
-                            username=contact_data.get("username"),
-                            phone=contact_data.get("phone"),
-                            avatar=None,
-                            connector_id=connector.connector_id,
+                    rows = [
+                        self.contact_row(
+                            connector,
+                            contact_data.get("contact_id"),
+                            contact_data,
+                            pushed_at,
                         )
-                        db.merge(contact)
-                        db.commit()
+                        for contact_data in payload
+                    ]
+
+                    await crud.upsert(
+                        db, models.Contact, rows, CONTACT_COLUMNS, "pushed_at"
+                    )
+                    await crud.record_changes(
+                        db,
+                        connector.user_id,
+                        "contact",
+                        (row["contact_id"] for row in rows),
+                    )
+                    await db.commit()
+
+                    crud.cache_contact_ids(
+                        connector.connector_id,
+                        {row["internal_id"]: row["contact_id"] for row in rows},
+                    )
 
                 elif command == "chats":
+                    contacts = ContactResolver(self, db, connector, pushed_at)
+                    await contacts.resolve(
+                        contact_id
+                        for chat_data in payload
+                        for contact_id in [
+                            (chat_data.get("last_message") or {}).get("contact_id"),
+                            *(chat_data.get("participants") or []),
+                        ]
+                    )
+
+                    chats = []
+                    participants = []
+                    last_messages = []
+
                     for chat_data in payload:
                         internal_chat_id = chat_data.get("chat_id")
+                        chat_id = crud.get_id(connector.connector_id, internal_chat_id)
 
-                        chat = models.Chat(
-                            chat_id=crud.get_id(
-                                connector.connector_id, internal_chat_id
-                            ),
-                            connector_id=connector.connector_id,
-                            internal_id=internal_chat_id,
-                            name=chat_data.get("name"),
-                            is_muted=False,
-                            is_archived=False,
+                        chats.append(
+                            dict(
+                                chat_id=chat_id,
+                                connector_id=connector.connector_id,
+                                user_id=connector.user_id,
+                                internal_id=internal_chat_id,
+                                name=chat_data.get("name"),
+                                is_muted=False,
+                                is_archived=False,
+                                pushed_at=pushed_at,
+                            )
                         )
 
-                        db.merge(chat)
-                        db.commit()
-
-                        chat_id = chat.chat_id
-
                         last_message = chat_data.get("last_message")
 
                         if last_message:
 
-                            # Get contact of the sender, else ask for it
-                            internal_contact_id = last_message.get("contact_id")
-
-                            # check if contact exists, else request contact
-                            maybe_contact = crud.get_contact_from_connector(
-                                db,
-                                connector.user_id,
-                                connector.connector_id,
-                                internal_contact_id,
-                            )
+                            # Contact of the sender
+                            contact_id = contacts[last_message.get("contact_id")]
 
-                            if not maybe_contact:
-                                contact = await self.get_contact(
-                                    connector.connector_type,
-                                    connector.connector_id,
-                                    internal_contact_id,
+                            if contact_id is None:
+                                _LOGGER.warning(
+                                    f"Skipped last message of chat {internal_chat_id}"
+                                    f" of connector {connector_id} without a sender."
                                 )
-                                new_contact = models.Contact(
-                                    contact_id=crud.get_id(
-                                        connector.connector_id, internal_contact_id
-                                    ),
-                                    internal_id=internal_contact_id,
-                                    service_id=connector.connector_type,
-                                    connector_id=connector.connector_id,
-                                    name=contact.get("name"),
-                                    username=contact.get("username"),
-                                    phone=contact.get("phone"),
-                                    avatar=contact.get("avatar"),
-                                    is_self=False,
-                                )
-                                db.merge(new_contact)
-                                db.commit()
-
-                                contact_id = new_contact.contact_id
                             else:
-                                contact_id = maybe_contact.contact_id
-
-                            # TODO: Reimplement last message
-                            # new_last_message = models.Message(
-                            #     message_id=last_message.get("message_id"),
-                            #     contact_id=contact_id,
-                            #     internal_id=chat_id,
-                            #     message=json.dumps(last_message.get("message")),
-                            #     sent_datetime=datetime.fromisoformat(last_message.get("sent_datetime"))
-                            # )
-
-                            # db.merge(new_last_message)
-                            # db.commit()
-
-                        participants = chat_data.get("participants")
-                        if participants:
-                            for participant in participants:
-                                c = crud.get_contact_from_connector(
-                                    db,
-                                    connector.user_id,
-                                    connector.connector_id,
-                                    participant,
-                                )
-                                if not c:
-                                    contact = await self.get_contact(
-                                        connector.connector_type,
-                                        connector.connector_id,
-                                        participant,
-                                    )
-                                    c = models.Contact(
-                                        contact_id=crud.get_id(
-                                            connector.connector_id, participant
-                                        ),
-                                        internal_id=participant,
-                                        service_id=connector.connector_type,
-                                        connector_id=connector.connector_id,
-                                        name=contact.get("name"),
-                                        username=contact.get("username"),
-                                        phone=contact.get("phone"),
-                                        avatar=contact.get("avatar"),
-                                        is_self=False,
-                                    )
-                                    db.merge(c)
-                                    db.commit()
-
-                                db.merge(
-                                    models.ContactsChatsRelationship(
-                                        contact_id=c.contact_id, chat_id=chat_id
+                                last_messages.append(
+                                    self.message_row(
+                                        connector,
+                                        last_message,
+                                        contact_id,
+                                        chat_id,
+                                        pushed_at,
                                     )
                                 )
-                                try:
-                                    db.commit()
-                                except sqlalchemy.exc.IntegrityError:
-                                    db.rollback()
 
-                elif command == "messages":
-                    for message_data in payload:
+                        for participant in chat_data.get("participants") or []:
+                            if participant is None:
+                                continue
 
-                        # Get contact of the sender, else ask for it
-                        internal_contact_id = message_data.get("contact_id")
+                            participants.append(
+                                dict(contact_id=contacts[participant], chat_id=chat_id)
+                            )
 
-                        # check if contact exists, else request contact
-                        c = crud.get_contact_from_connector(
-                            db,
+                    await contacts.save()
+                    await crud.upsert(db, models.Chat, chats, CHAT_COLUMNS, "pushed_at")
+                    await crud.upsert(
+                        db, models.ContactsChatsRelationship, participants
+                    )
+                    await crud.upsert(
+                        db, models.Message, last_messages, MESSAGE_COLUMNS, "pushed_at"
+                    )
+                    await crud.update_last_messages(db, last_messages)
+                    await contacts.record_changes()
+                    await crud.record_changes(
+                        db,
+                        connector.user_id,
+                        "chat",
+                        (chat["chat_id"] for chat in chats),
+                    )
+                    await crud.record_changes(
+                        db,
+                        connector.user_id,
+                        "message",
+                        (message["message_id"] for message in last_messages),
+                    )
+                    await db.commit()
+
+                    crud.cache_contact_ids(connector.connector_id, contacts.contact_ids)
+
+                    for chat in chats:
+                        await self.events.publish(
                             connector.user_id,
-                            connector.connector_id,
-                            internal_contact_id,
+                            chat_event(chat["chat_id"], "connector_id", "name"),
                         )
-                        if not c:
-                            contact = await self.get_contact(
-                                connector.connector_type,
-                                connector.connector_id,
-                                internal_contact_id,
-                            )
-                            c = models.Contact(
-                                contact_id=crud.get_id(
-                                    connector.connector_id, internal_contact_id
-                                ),
-                                internal_id=internal_contact_id,
-                                service_id=connector.connector_type,
-                                connector_id=connector.connector_id,
-                                name=contact.get("name"),
-                                username=contact.get("username"),
-                                phone=contact.get("phone"),
-                                avatar=contact.get("avatar"),
-                                is_self=False,
-                            )
-                            db.merge(c)
-                            db.commit()
-                        else:
-                            pass
-
-                        chat = (
-                            db.query(models.Chat)
-                            .filter(
-                                models.Chat.connector_id == connector_id,
-                                models.Chat.internal_id == message_data.get("chat_id"),
+
+                    await self.publish_messages(connector, last_messages)
+
+                elif command == "messages":
+                    contacts = ContactResolver(self, db, connector, pushed_at)
+                    await contacts.resolve(
+                        message_data.get("contact_id") for message_data in payload
+                    )
+
+                    # internal chat id -> chat id, derived without a lookup
+                    chat_ids = {}
+                    messages = []
+
+                    for message_data in payload:
+
+                        # Contact of the sender
+                        contact_id = contacts[message_data.get("contact_id")]
+
+                        if contact_id is None:
+                            _LOGGER.warning(
+                                f"Skipped message {message_data.get('message_id')}"
+                                f" of connector {connector_id} without a sender."
                             )
-                            .first()
-                        )
+                            continue
 
-                        if not chat:
-                            chat = models.Chat(
-                                chat_id=crud.get_id(
-                                    connector.connector_id, message_data.get("chat_id")
-                                ),
-                                connector_id=connector_id,
-                                internal_id=message_data.get("chat_id"),
-                                name="Loading...",
-                                is_muted=False,
-                                is_archived=False,
+                        internal_chat_id = message_data.get("chat_id")
+                        chat_id = chat_ids.get(internal_chat_id)
+
+                        if chat_id is None:
+                            chat_id = chat_ids[internal_chat_id] = crud.get_id(
+                                connector.connector_id, internal_chat_id
                             )
 
-                            db.merge(chat)
-                            db.commit()
-
-                        new_last_message = models.Message(
-                            message_id=crud.get_message_id(
-                                connector.connector_id, message_data.get("message_id"), chat.chat_id
-                            ),
-                            internal_id=message_data.get("message_id"),
-                            contact_id=crud.get_id(connector.connector_id, internal_contact_id),
-                            chat_id=chat.chat_id,
-                            message=json.dumps(message_data.get("message")),
-                            sent_datetime=datetime.fromisoformat(
-                                message_data.get("sent_datetime").split("Z")[0]
-                            ),
+                        messages.append(
+                            self.message_row(
+                                connector, message_data, contact_id, chat_id, pushed_at
+                            )
                         )
 
-                        db.merge(new_last_message)
-                        db.commit()
-
-        finally:
-            db.close()
+                    # Newest message of each chat in this payload
+                    last_messages = {}
+
+                    for message in messages:
+                        last_message = last_messages.get(message["chat_id"])
+
+                        if last_message is None or (
+                            message["sent_datetime"],
+                            message["message_id"],
+                        ) > (last_message["sent_datetime"], last_message["message_id"]):
+                            last_messages[message["chat_id"]] = message
+
+                    # Chats the service did not push yet, existing ones are kept.
+                    # Without a pushed_at, so the chat's own push always updates them.
+                    placeholders = [
+                        dict(
+                            chat_id=chat_id,
+                            connector_id=connector_id,
+                            user_id=connector.user_id,
+                            internal_id=internal_chat_id,
+                            name="Loading...",
+                            is_muted=False,
+                            is_archived=False,
+                        )
+                        for internal_chat_id, chat_id in chat_ids.items()
+                    ]
+
+                    await contacts.save()
+                    await crud.upsert(db, models.Chat, placeholders)
+                    await crud.upsert(
+                        db, models.Message, messages, MESSAGE_COLUMNS, "pushed_at"
+                    )
+                    await crud.update_last_messages(db, last_messages.values())
+                    await contacts.record_changes()
+                    # The chats have new last messages
+                    await crud.record_changes(
+                        db, connector.user_id, "chat", chat_ids.values()
+                    )
+                    await crud.record_changes(
+                        db,
+                        connector.user_id,
+                        "message",
+                        (message["message_id"] for message in messages),
+                    )
+                    await db.commit()
+
+                    crud.cache_contact_ids(connector.connector_id, contacts.contact_ids)
+
+                    await self.publish_messages(connector, messages)
+
+    async def publish_messages(self, connector: models.Connector, messages: List[Dict]):
+        """Publish the new or changed messages, one event per chat."""
+
+        chats: Dict[int, List[int]] = {}
+
+        for message in messages:
+            chats.setdefault(message["chat_id"], []).append(message["message_id"])
+
+        for chat_id, message_ids in chats.items():
+            await self.events.publish(
+                connector.user_id, messages_event(chat_id, message_ids)
+            )
 
     async def get_contact(self, connector_type, connector_id, contact_id):
         return await self.pool.get(
             f"{connector_type}/{connector_id}/{str(uuid.uuid4())}/get_contact/{contact_id}",
             {},
+            shared=True,
+        )
+
+    async def get_contacts(
+        self, connector: models.Connector, contact_ids: List
+    ) -> Dict[str, Dict]:
+        """Request several contacts from a service, concurrently and in batches
+        if the service supports it. Returns the contacts by their (string) internal id."""
+
+        semaphore = asyncio.Semaphore(CONTACT_REQUEST_CONCURRENCY)
+        contacts = {}
+
+        async def get_batch(batch):
+            async with semaphore:
+                response = await self.pool.get(
+                    f"{connector.connector_type}/{connector.connector_id}/{str(uuid.uuid4())}/get_contacts",
+                    {"contact_ids": batch},
+                    shared=True,
+                )
+
+            for contact in response:
+                contacts[str(contact.get("contact_id"))] = contact
+
+        async def get_one(contact_id):
+            async with semaphore:
+                contacts[str(contact_id)] = await self.get_contact(
+                    connector.connector_type, connector.connector_id, contact_id
+                )
+
+        if connector.connector_type in self.batch_contact_connectors:
+            await asyncio.gather(
+                *(
+                    get_batch(contact_ids[i : i + CONTACT_BATCH_SIZE])
+                    for i in range(0, len(contact_ids), CONTACT_BATCH_SIZE)
+                )
+            )
+
+        # Contacts that were not part of a batch response are requested one by one
+        await asyncio.gather(
+            *(
+                get_one(contact_id)
+                for contact_id in contact_ids
+                if str(contact_id) not in contacts
+            )
+        )
+
+        return contacts
+
+    @staticmethod
+    def contact_row(
+        connector: models.Connector,
+        internal_contact_id,
+        contact: Dict,
+        pushed_at: datetime,
+    ):
+        return dict(
+            contact_id=crud.get_id(connector.connector_id, internal_contact_id),
+            internal_id=internal_contact_id,
+            service_id=connector.connector_type,
+            connector_id=connector.connector_id,
+            name=contact.get("name"),
+            username=contact.get("username"),
+            phone=contact.get("phone"),
+            avatar=contact.get("avatar"),
+            pushed_at=pushed_at,
+        )
+
+    @staticmethod
+    def message_row(
+        connector: models.Connector,
+        message: Dict,
+        contact_id: int,
+        chat_id: int,
+        pushed_at: datetime,
+    ):
+        return dict(
+            message_id=crud.get_message_id(
+                connector.connector_id, message.get("message_id"), chat_id
+            ),
+            internal_id=message.get("message_id"),
+            contact_id=contact_id,
+            chat_id=chat_id,
+            message=json.dumps(message.get("message")),
+            sent_datetime=datetime.fromisoformat(
+                message.get("sent_datetime").split("Z")[0]
+            ),
+            pushed_at=pushed_at,
+        )
+
+
+class ContactResolver:
+    """Resolves the internal contact ids of one payload to contact ids.
+    All ids are looked up at once. Contacts that do not exist yet are requested
+    from the service (each one once) and collected, so they can be written
+    together with the rest of the payload."""
+
+    def __init__(
+        self,
+        handler: ServiceHandler,
+        db: AsyncSession,
+        connector: models.Connector,
+        pushed_at: datetime,
+    ):
+        self.handler = handler
+        self.db = db
+        self.connector = connector
+        self.pushed_at = pushed_at
+
+        # internal contact id (as string) -> contact id
+        self.contact_ids: Dict[str, int] = {}
+        self.new_contacts: List[Dict] = []
+
+    async def resolve(self, internal_contact_ids: Iterable):
+        """Resolve all given internal contact ids."""
+
+        # The ids keep the type the service sent, because unknown ones are requested
+        wanted = {
+            str(internal_contact_id): internal_contact_id
+            for internal_contact_id in internal_contact_ids
+            if internal_contact_id is not None
+            and str(internal_contact_id) not in self.contact_ids
+        }
+
+        self.contact_ids.update(
+            await crud.get_contact_ids_from_connector(
+                self.db, self.connector.connector_id, list(wanted)
+            )
+        )
+
+        unknown = [
+            internal_contact_id
+            for key, internal_contact_id in wanted.items()
+            if key not in self.contact_ids
+        ]
+
+        if not unknown:
+            return
+
+        contacts = await self.handler.get_contacts(self.connector, unknown)
+
+        for internal_contact_id in unknown:
+            row = self.handler.contact_row(
+                self.connector,
+                internal_contact_id,
+                contacts[str(internal_contact_id)],
+                self.pushed_at,
+            )
+            self.new_contacts.append(row)
+            self.contact_ids[str(internal_contact_id)] = row["contact_id"]
+
+    def __getitem__(self, internal_contact_id) -> Optional[int]:
+        """Contact id of a resolved internal contact id, None for no contact."""
+
+        if internal_contact_id is None:
+            return None
+
+        return self.contact_ids[str(internal_contact_id)]
+
+    async def save(self):
+        """Add the new contacts to the current transaction."""
+
+        await crud.upsert(
+            self.db, models.Contact, self.new_contacts, CONTACT_COLUMNS, "pushed_at"
+        )
+
+    async def record_changes(self):
+        """Log the new contacts for /sync."""
+
+        await crud.record_changes(
+            self.db,
+            self.connector.user_id,
+            "contact",
+            (row["contact_id"] for row in self.new_contacts),
         )
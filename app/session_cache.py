@@ -0,0 +1,95 @@
+from datetime import datetime
+from typing import Optional
+
+from fastapi_mqtt.fastmqtt import FastMQTT
+
+from app.cache import INVALIDATE_TOPIC, MISSING, TTLCache, publish_invalidation
+from app.schemas import AuthUser
+
+
+class SessionCache:
+    """Caches the authenticated user of each session by the jti of its token,
+    so authenticated requests do not have to query the database.
+
+    Entries are invalidated when a session is ended or refreshed. Invalidations
+    are published on moca/invalidate/..., so all server processes connected to
+    the broker drop their entries too. If publishing fails, the other processes
+    keep their entries for at most `ttl` seconds."""
+
+    TOPIC = INVALIDATE_TOPIC
+
+    def __init__(self, mqtt: FastMQTT, max_size: int = 10000, ttl: float = 60):
+        self.mqtt = mqtt
+
+        # session id -> (user, valid until)
+        self.cache = TTLCache(max_size, ttl)
+
+        # Increased by every invalidation, so users loaded before an invalidation
+        # are not cached after it
+        self.generation = 0
+
+    def get(self, session_id: str) -> Optional[AuthUser]:
+        entry = self.cache.get(session_id)
+
+        if entry is MISSING:
+            return None
+
+        user, valid_until = entry
+
+        if valid_until <= datetime.now():
+            self.cache.invalidate(session_id)
+            return None
+
+        return user.copy()
+
+    def set(self, user: AuthUser, valid_until: datetime, generation: int):
+        """Cache the user of a session, unless an invalidation happened since
+        `generation` was read."""
+
+        if generation == self.generation:
+            self.cache.set(user.session_id, (user.copy(), valid_until))
+
+    async def invalidate_session(self, session_id):
+        self.drop_session(str(session_id))
+        await publish_invalidation(self.mqtt, f"moca/invalidate/session/{session_id}")
+
+    async def invalidate_user(self, user_id: int):
+        """Invalidate all sessions of a user."""
+
+        self.drop_user(user_id)
+        await publish_invalidation(self.mqtt, f"moca/invalidate/user/{user_id}")
+
+    def drop_session(self, session_id: str):
+        self.generation += 1
+        self.cache.invalidate(session_id)
+
+    def drop_user(self, user_id: int):
+        self.generation += 1
+        self.cache.invalidate_where(lambda _, entry: entry[0].user_id == user_id)
+
+    def handle(self, topic: str) -> bool:
+        """Drop the entries an invalidation message is about.
+        Returns False if the topic is not a session invalidation topic."""
+
+        parts = topic.split("/")
+
+        if parts[:2] != ["moca", "invalidate"] or len(parts) != 4:
+            return False
+
+        if parts[2] == "session":
+            self.drop_session(parts[3])
+        elif parts[2] == "user":
+            if parts[3].isdigit():
+                self.drop_user(int(parts[3]))
+        else:
+            # Invalidations of other caches
+            return False
+
+        return True
+
+    def clear(self):
+        self.generation += 1
+        self.cache.clear()
+
+    def stats(self):
+        return self.cache.stats()
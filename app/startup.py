@@ -0,0 +1,49 @@
+import logging
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class StartupReport:
+    """Durations of the steps of starting a worker (importing the routers,
+    starting the background tasks, ...), so slow cold starts can be traced."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.finished = None
+
+        # (step, duration in seconds), in the order the steps ran
+        self.steps: List[Tuple[str, float]] = []
+
+    @contextmanager
+    def measure(self, step: str):
+        started = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.steps.append((step, time.perf_counter() - started))
+
+    def finish(self):
+        """Log the report, once the worker is ready."""
+
+        self.finished = time.perf_counter()
+        steps = "\n".join(
+            f"  {duration * 1000:8.1f} ms  {step}"
+            for step, duration in sorted(self.steps, key=lambda step: -step[1])
+        )
+
+        _LOGGER.info(
+            f"Started in {(self.finished - self.started) * 1000:.1f} ms:\n{steps}"
+        )
+
+    def stats(self) -> Dict:
+        return {
+            "total": self.finished - self.started if self.finished else None,
+            "steps": {step: duration for step, duration in self.steps},
+        }
+
+
+startup_report = StartupReport()
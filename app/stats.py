@@ -0,0 +1,15 @@
+from typing import Iterable, Optional
+
+# Number of recent latencies kept per statistic
+LATENCY_SAMPLES = 1000
+
+
+def percentile(values: Iterable[float], fraction: float) -> Optional[float]:
+    """Value below which the fraction of the values lies, or None without values."""
+
+    ordered = sorted(values)
+
+    if not ordered:
+        return None
+
+    return ordered[int(fraction * (len(ordered) - 1))]
@@ -0,0 +1,32 @@
+import logging
+import os
+
+_LOGGER = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Written when the image is built (scripts/write_version.py)
+VERSION_FILE = os.path.join(ROOT, "app", "VERSION")
+
+
+def resolve_version() -> str:
+    """Read the version from the version file, or ask setuptools_scm for it
+    if there is none (e.g. in a development checkout)."""
+
+    try:
+        with open(VERSION_FILE) as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        pass
+
+    try:
+        from setuptools_scm import get_version
+
+        return get_version(root=ROOT)
+    except Exception:
+        _LOGGER.warning("Could not determine the server version.", exc_info=True)
+        return "0.0.0"
+
+
+# Resolved once per process
+VERSION = resolve_version()
@@ -0,0 +1,59 @@
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import create_engine
+
+from app import models  # registers all tables on Base.metadata
+from app.database import SQLALCHEMY_DATABASE_URL, Base
+
+config = context.config
+
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = Base.metadata
+
+url = config.get_main_option("sqlalchemy.url") or SQLALCHEMY_DATABASE_URL
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """Leave out sqlite_sequence, which SQLite creates for AUTOINCREMENT tables."""
+
+    return not (type_ == "table" and name == "sqlite_sequence")
+
+
+def run_migrations_offline():
+    """Print the SQL of the migrations instead of running them."""
+
+    context.configure(
+        url=url,
+        target_metadata=target_metadata,
+        literal_binds=True,
+        render_as_batch=True,
+        include_object=include_object,
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    engine = create_engine(url)
+
+    with engine.connect() as connection:
+        # SQLite cannot alter most things in place, batch mode recreates the table
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            render_as_batch=True,
+            include_object=include_object,
+        )
+
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,136 @@
+"""initial schema
+
+Revision ID: 5b1e0c7d2a41
+Revises:
+Create Date: 2021-05-20 10:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "5b1e0c7d2a41"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases created with Base.metadata.create_all() already have the tables
+    existing = sa.inspect(op.get_bind()).get_table_names()
+
+    if "users" not in existing:
+        op.create_table(
+            "users",
+            sa.Column("user_id", sa.Integer(), nullable=False),
+            sa.Column("username", sa.String(length=255), nullable=True),
+            sa.Column("mail", sa.String(length=255), nullable=True),
+            sa.Column("hashed_password", sa.String(length=255), nullable=True),
+            sa.Column("is_verified", sa.Boolean(), nullable=True),
+            sa.Column("verification_code", sa.String(length=6), nullable=True),
+            sa.Column(
+                "created_at",
+                sa.DateTime(),
+                server_default=sa.func.now(),
+                nullable=False,
+            ),
+            sa.Column(
+                "updated_at",
+                sa.DateTime(),
+                server_default=sa.func.now(),
+                nullable=False,
+            ),
+            sa.PrimaryKeyConstraint("user_id"),
+        )
+
+    if "connectors" not in existing:
+        op.create_table(
+            "connectors",
+            sa.Column("connector_id", sa.Integer(), nullable=False),
+            sa.Column("connector_type", sa.String(length=255), nullable=True),
+            sa.Column("user_id", sa.Integer(), nullable=True),
+            sa.Column("connector_user_id", sa.String(length=255), nullable=True),
+            sa.Column("configuration", sa.String(), nullable=True),
+            sa.Column("is_finished", sa.Boolean(), nullable=False),
+            sa.ForeignKeyConstraint(["user_id"], ["users.user_id"]),
+            sa.PrimaryKeyConstraint("connector_id"),
+        )
+
+    if "sessions" not in existing:
+        op.create_table(
+            "sessions",
+            sa.Column("session_id", sa.Integer(), nullable=False),
+            sa.Column("user_id", sa.Integer(), nullable=True),
+            sa.Column("name", sa.String(length=255), nullable=True),
+            sa.Column("valid_until", sa.DateTime(), nullable=True),
+            sa.ForeignKeyConstraint(["user_id"], ["users.user_id"]),
+            sa.PrimaryKeyConstraint("session_id"),
+        )
+
+    if "contacts" not in existing:
+        op.create_table(
+            "contacts",
+            sa.Column("contact_id", sa.Integer(), autoincrement=True, nullable=False),
+            sa.Column("internal_id", sa.String(), nullable=True),
+            sa.Column("service_id", sa.String(length=255), nullable=True),
+            sa.Column("name", sa.String(length=255), nullable=True),
+            sa.Column("username", sa.String(length=255), nullable=True),
+            sa.Column("phone", sa.String(length=255), nullable=True),
+            sa.Column("avatar", sa.String(length=255), nullable=True),
+            sa.Column("connector_id", sa.Integer(), nullable=True),
+            sa.Column("is_self", sa.Boolean(), nullable=False),
+            sa.ForeignKeyConstraint(
+                ["connector_id"], ["connectors.connector_id"], ondelete="CASCADE"
+            ),
+            sa.PrimaryKeyConstraint("contact_id"),
+        )
+
+    if "chats" not in existing:
+        op.create_table(
+            "chats",
+            sa.Column("chat_id", sa.Integer(), autoincrement=True, nullable=False),
+            sa.Column("internal_id", sa.String(), nullable=True),
+            sa.Column("connector_id", sa.Integer(), nullable=False),
+            sa.Column("name", sa.String(length=255), nullable=True),
+            sa.Column("is_muted", sa.Boolean(), nullable=True),
+            sa.Column("is_archived", sa.Boolean(), nullable=True),
+            sa.Column("pin_position", sa.Integer(), nullable=True),
+            sa.ForeignKeyConstraint(["connector_id"], ["connectors.connector_id"]),
+            sa.PrimaryKeyConstraint("chat_id"),
+        )
+
+    if "contacts_chats_relationship" not in existing:
+        op.create_table(
+            "contacts_chats_relationship",
+            sa.Column("contact_id", sa.Integer(), nullable=False),
+            sa.Column("chat_id", sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(["chat_id"], ["chats.chat_id"]),
+            sa.ForeignKeyConstraint(["contact_id"], ["contacts.contact_id"]),
+            sa.PrimaryKeyConstraint("contact_id", "chat_id"),
+        )
+
+    if "messages" not in existing:
+        op.create_table(
+            "messages",
+            sa.Column("message_id", sa.Integer(), autoincrement=True, nullable=False),
+            sa.Column("internal_id", sa.String(), nullable=True),
+            sa.Column("contact_id", sa.Integer(), nullable=False),
+            sa.Column("chat_id", sa.Integer(), nullable=False),
+            sa.Column("message", sa.String(), nullable=True),
+            sa.Column("sent_datetime", sa.DateTime(), nullable=True),
+            sa.ForeignKeyConstraint(["chat_id"], ["chats.chat_id"], ondelete="CASCADE"),
+            sa.ForeignKeyConstraint(
+                ["contact_id"], ["contacts.contact_id"], ondelete="CASCADE"
+            ),
+            sa.PrimaryKeyConstraint("message_id"),
+        )
+
+
+def downgrade():
+    op.drop_table("messages")
+    op.drop_table("contacts_chats_relationship")
+    op.drop_table("chats")
+    op.drop_table("contacts")
+    op.drop_table("sessions")
+    op.drop_table("connectors")
+    op.drop_table("users")
@@ -0,0 +1,48 @@
+"""add indexes for hot queries
+
+Revision ID: 8d3f6a2c9e17
+Revises: 5b1e0c7d2a41
+Create Date: 2021-05-20 10:30:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "8d3f6a2c9e17"
+down_revision = "5b1e0c7d2a41"
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ("ix_messages_chat_id_sent_datetime", "messages", ["chat_id", "sent_datetime"]),
+    (
+        "ix_contacts_connector_id_internal_id",
+        "contacts",
+        ["connector_id", "internal_id"],
+    ),
+    ("ix_chats_connector_id_internal_id", "chats", ["connector_id", "internal_id"]),
+    (
+        "ix_contacts_chats_relationship_chat_id",
+        "contacts_chats_relationship",
+        ["chat_id"],
+    ),
+    ("ix_connectors_user_id", "connectors", ["user_id"]),
+    ("ix_sessions_user_id_valid_until", "sessions", ["user_id", "valid_until"]),
+    ("ix_users_username", "users", ["username"]),
+]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+
+    for name, table, columns in INDEXES:
+        # Tables created with Base.metadata.create_all() already have the index
+        if name not in {index["name"] for index in inspector.get_indexes(table)}:
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
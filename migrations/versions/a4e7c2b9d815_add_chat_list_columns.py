@@ -0,0 +1,64 @@
+"""add user and last message to chats
+
+Revision ID: a4e7c2b9d815
+Revises: 8d3f6a2c9e17
+Create Date: 2021-05-27 09:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "a4e7c2b9d815"
+down_revision = "8d3f6a2c9e17"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+
+    # Tables created with Base.metadata.create_all() already have the columns
+    if "last_message_id" in {
+        column["name"] for column in inspector.get_columns("chats")
+    }:
+        return
+
+    with op.batch_alter_table("chats") as batch_op:
+        batch_op.add_column(sa.Column("user_id", sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column("last_message_id", sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column("last_activity_at", sa.DateTime(), nullable=True))
+
+    # The message subqueries use ix_messages_chat_id_sent_datetime
+    op.execute(
+        """
+        UPDATE chats SET
+            user_id = (
+                SELECT user_id FROM connectors
+                WHERE connectors.connector_id = chats.connector_id
+            ),
+            last_message_id = (
+                SELECT message_id FROM messages
+                WHERE messages.chat_id = chats.chat_id
+                ORDER BY sent_datetime DESC, message_id DESC
+                LIMIT 1
+            ),
+            last_activity_at = (
+                SELECT max(sent_datetime) FROM messages
+                WHERE messages.chat_id = chats.chat_id
+            )
+        """
+    )
+
+    op.create_index(
+        "ix_chats_user_id_last_activity_at", "chats", ["user_id", "last_activity_at"]
+    )
+
+
+def downgrade():
+    op.drop_index("ix_chats_user_id_last_activity_at", table_name="chats")
+
+    with op.batch_alter_table("chats") as batch_op:
+        batch_op.drop_column("last_activity_at")
+        batch_op.drop_column("last_message_id")
+        batch_op.drop_column("user_id")
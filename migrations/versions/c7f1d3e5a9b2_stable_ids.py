@@ -0,0 +1,220 @@
+"""stable ids for contacts, chats and messages
+
+The ids were derived from Python's hash(), which differs between processes, so
+the same contact, chat or message could be stored once per worker. This gives
+every row the id app.ids.stable_id derives for it. No row is deleted: of the
+rows that were stored more than once, only the first gets the new id, the
+others keep their old ids. Rows without an internal id (e.g. sent from the
+debug endpoints) keep their old ids too, they have nothing to derive one from.
+
+Foreign keys must not be enforced while the ids change, which holds for SQLite
+(databases created before MOCA_DATABASE_URL existed are SQLite databases).
+The old and new ids are kept in a temporary table, so every id column is
+rewritten with one statement, and messages are read in batches.
+The old ids cannot be restored, so the downgrade only changes the column types.
+
+Revision ID: c7f1d3e5a9b2
+Revises: a4e7c2b9d815
+Create Date: 2021-06-03 14:00:00.000000
+"""
+from typing import Dict
+
+from alembic import op
+import sqlalchemy as sa
+
+from app.ids import stable_id
+
+
+# revision identifiers, used by Alembic.
+revision = "c7f1d3e5a9b2"
+down_revision = "a4e7c2b9d815"
+branch_labels = None
+depends_on = None
+
+
+ID_COLUMNS = [
+    ("contacts", "contact_id"),
+    ("chats", "chat_id"),
+    ("chats", "last_message_id"),
+    ("messages", "message_id"),
+    ("messages", "contact_id"),
+    ("messages", "chat_id"),
+    ("contacts_chats_relationship", "contact_id"),
+    ("contacts_chats_relationship", "chat_id"),
+]
+
+# Kind of id in each id column
+ID_KINDS = {
+    "contact_id": "contact",
+    "chat_id": "chat",
+    "message_id": "message",
+    "last_message_id": "message",
+}
+
+# Messages whose new ids are computed and stored at once
+BATCH_SIZE = 10000
+
+# Old id -> new id of every contact, chat and message, in the order they were read
+stable_ids = sa.Table(
+    "stable_ids",
+    sa.MetaData(),
+    sa.Column("kind", sa.String(16), primary_key=True),
+    sa.Column("old_id", sa.BigInteger(), primary_key=True),
+    sa.Column("new_id", sa.BigInteger(), nullable=False),
+    sa.Column("position", sa.Integer(), nullable=False),
+    sa.Index("ix_stable_ids_kind_new_id", "kind", "new_id"),
+    prefixes=["TEMPORARY"],
+)
+
+
+def upgrade():
+    bind = op.get_bind()
+
+    # SQLite integers have 64 bits already
+    if bind.dialect.name != "sqlite":
+        for table, column in ID_COLUMNS:
+            op.alter_column(
+                table, column, type_=sa.BigInteger(), existing_type=sa.Integer()
+            )
+
+    stable_ids.create(bind)
+
+    # Of rows with the same new id, the first one gets it
+    contacts = bind.execute(
+        sa.text("SELECT contact_id, connector_id, internal_id, is_self FROM contacts")
+    ).fetchall()
+    contact_ids = new_ids(
+        (row.contact_id, row.internal_id, (row.connector_id, row.internal_id))
+        for row in sorted(contacts, key=lambda row: not row.is_self)
+    )
+    insert_ids(bind, "contact", contact_ids.items())
+
+    # Chats with settings of the user first
+    chats = bind.execute(
+        sa.text(
+            "SELECT chat_id, connector_id, internal_id, is_muted, is_archived,"
+            " pin_position FROM chats"
+        )
+    ).fetchall()
+    chat_ids = new_ids(
+        (row.chat_id, row.internal_id, (row.connector_id, row.internal_id))
+        for row in sorted(
+            chats,
+            key=lambda row: (
+                row.pin_position is None,
+                not row.is_muted,
+                not row.is_archived,
+            ),
+        )
+    )
+    insert_ids(bind, "chat", chat_ids.items())
+
+    # Messages are read in batches, there may be millions of them
+    messages = bind.execution_options(stream_results=True).execute(
+        sa.text(
+            "SELECT message_id, messages.internal_id, messages.chat_id, connector_id"
+            " FROM messages JOIN chats ON chats.chat_id = messages.chat_id"
+        )
+    )
+    position = 0
+
+    while True:
+        rows = messages.fetchmany(BATCH_SIZE)
+
+        if not rows:
+            break
+
+        insert_ids(
+            bind,
+            "message",
+            (
+                (
+                    row.message_id,
+                    row.message_id
+                    if row.internal_id is None
+                    else stable_id(
+                        row.connector_id, chat_ids[row.chat_id], row.internal_id
+                    ),
+                )
+                for row in rows
+            ),
+            position,
+        )
+        position += len(rows)
+
+    # Messages stored more than once keep their old ids, except for the first one
+    op.execute(
+        """
+        UPDATE stable_ids SET new_id = old_id
+        WHERE kind = 'message' AND EXISTS (
+            SELECT 1 FROM stable_ids kept
+            WHERE kept.kind = stable_ids.kind
+            AND kept.new_id = stable_ids.new_id
+            AND kept.position < stable_ids.position
+        )
+        """
+    )
+
+    for table, column in ID_COLUMNS:
+        update(bind, table, column, ID_KINDS[column])
+
+    stable_ids.drop(bind)
+
+
+def downgrade():
+    if op.get_bind().dialect.name != "sqlite":
+        for table, column in reversed(ID_COLUMNS):
+            op.alter_column(
+                table, column, type_=sa.Integer(), existing_type=sa.BigInteger()
+            )
+
+
+def new_ids(rows) -> Dict[int, int]:
+    """Old id -> new id of (old id, internal id, parts of the new id) rows.
+    Rows without an internal id, and rows whose new id an earlier row got,
+    keep their old id, so no row is lost."""
+
+    ids = {}
+    taken = set()
+
+    for old_id, internal_id, parts in rows:
+        new_id = stable_id(*parts)
+
+        if internal_id is None or new_id in taken:
+            new_id = old_id
+
+        taken.add(new_id)
+        ids[old_id] = new_id
+
+    return ids
+
+
+def insert_ids(bind, kind: str, ids, position: int = 0):
+    """Store old id -> new id pairs of a kind, in the order of their positions."""
+
+    rows = [
+        dict(kind=kind, old_id=old, new_id=new, position=position + i)
+        for i, (old, new) in enumerate(ids)
+    ]
+
+    if rows:
+        bind.execute(stable_ids.insert(), rows)
+
+
+def update(bind, table: str, column: str, kind: str):
+    """Replace the old ids in a column with the new ones, in one pass over the table."""
+
+    bind.execute(
+        sa.text(
+            f"""
+            UPDATE {table} SET {column} = (
+                SELECT new_id FROM stable_ids
+                WHERE kind = :kind AND old_id = {table}.{column}
+            )
+            WHERE {column} IN (
+                SELECT old_id FROM stable_ids WHERE kind = :kind AND old_id != new_id
+            )
+            """
+        ),
+        dict(kind=kind),
+    )
@@ -0,0 +1,81 @@
+"""add the change log for /sync
+
+Every existing contact, chat and message gets one change, so clients that sync
+from cursor 0 get all of them.
+
+Revision ID: e2b8d4f6a1c3
+Revises: c7f1d3e5a9b2
+Create Date: 2021-06-10 10:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e2b8d4f6a1c3"
+down_revision = "c7f1d3e5a9b2"
+branch_labels = None
+depends_on = None
+
+# app.models.Id
+Id = sa.BigInteger().with_variant(sa.Integer(), "sqlite")
+
+
+def upgrade():
+    # Databases created with Base.metadata.create_all() already have the table
+    if "changes" in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table(
+        "changes",
+        sa.Column("change_id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column(
+            "kind",
+            sa.String(length=16),
+            nullable=False,
+            comment="chat, message or contact",
+        ),
+        sa.Column("object_id", Id, nullable=False),
+        sa.Column("deleted", sa.Boolean(), nullable=False),
+        sa.Column(
+            "changed_at", sa.DateTime(), server_default=sa.func.now(), nullable=False
+        ),
+        sa.PrimaryKeyConstraint("change_id"),
+        sqlite_autoincrement=True,
+    )
+    op.create_index("ix_changes_user_id_change_id", "changes", ["user_id", "change_id"])
+    op.create_index("ix_changes_kind_object_id", "changes", ["kind", "object_id"])
+
+    # Contacts first, so clients know the senders of the messages they get
+    op.execute(
+        """
+        INSERT INTO changes (user_id, kind, object_id, deleted)
+        SELECT connectors.user_id, 'contact', contact_id, false FROM contacts
+        JOIN connectors ON connectors.connector_id = contacts.connector_id
+        ORDER BY contact_id
+        """
+    )
+    op.execute(
+        """
+        INSERT INTO changes (user_id, kind, object_id, deleted)
+        SELECT user_id, 'chat', chat_id, false FROM chats
+        WHERE user_id IS NOT NULL
+        ORDER BY chat_id
+        """
+    )
+    op.execute(
+        """
+        INSERT INTO changes (user_id, kind, object_id, deleted)
+        SELECT chats.user_id, 'message', message_id, false FROM messages
+        JOIN chats ON chats.chat_id = messages.chat_id
+        WHERE chats.user_id IS NOT NULL
+        ORDER BY messages.sent_datetime, message_id
+        """
+    )
+
+
+def downgrade():
+    op.drop_index("ix_changes_kind_object_id", table_name="changes")
+    op.drop_index("ix_changes_user_id_change_id", table_name="changes")
+    op.drop_table("changes")
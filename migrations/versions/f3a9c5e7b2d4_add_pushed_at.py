@@ -0,0 +1,37 @@
+"""add pushed_at to contacts, chats and messages
+
+Existing rows get no time, so the next push of them always updates them.
+
+Revision ID: f3a9c5e7b2d4
+Revises: e2b8d4f6a1c3
+Create Date: 2021-06-14 10:00:00.000000
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "f3a9c5e7b2d4"
+down_revision = "e2b8d4f6a1c3"
+branch_labels = None
+depends_on = None
+
+TABLES = ["contacts", "chats", "messages"]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+
+    for table in TABLES:
+        # Tables created with Base.metadata.create_all() already have the column
+        if "pushed_at" in {column["name"] for column in inspector.get_columns(table)}:
+            continue
+
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.add_column(sa.Column("pushed_at", sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    for table in TABLES:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column("pushed_at")
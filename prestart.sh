@@ -0,0 +1,4 @@
+#! /usr/bin/env bash
+
+# Run by the uvicorn-gunicorn image before the workers start
+cd /app && alembic upgrade head
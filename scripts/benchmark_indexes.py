@@ -0,0 +1,192 @@
+"""Compare query plans and timings of the hot queries without and with the indexes.
+
+Creates a temporary SQLite database at the initial schema, fills it with fake data,
+runs the queries, upgrades it to the migration that adds the indexes and runs them
+again.
+
+    python scripts/benchmark_indexes.py --messages 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, select
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import models  # noqa: E402
+
+INITIAL_REVISION = "5b1e0c7d2a41"
+INDEXES_REVISION = "8d3f6a2c9e17"
+
+
+def queries():
+    """The queries of the hot paths, with example parameters."""
+
+    now = datetime(2021, 1, 1)
+
+    return {
+        "messages of a chat": select(models.Message)
+        .filter(models.Message.chat_id == 7)
+        .order_by(models.Message.sent_datetime.desc())
+        .limit(10),
+        "contact ids by internal id": select(
+            models.Contact.internal_id, models.Contact.contact_id
+        ).filter(
+            models.Contact.connector_id == 3,
+            models.Contact.internal_id.in_(["c17", "c23", "c99"]),
+        ),
+        "chat by internal id": select(models.Chat.chat_id).filter(
+            models.Chat.connector_id == 3, models.Chat.internal_id == "chat-7"
+        ),
+        "participants of a chat": select(models.Contact)
+        .join(models.ContactsChatsRelationship)
+        .filter(models.ContactsChatsRelationship.chat_id == 7),
+        "connectors of a user": select(models.Connector).filter(
+            models.Connector.user_id == 5
+        ),
+        "valid sessions of a user": select(models.Session).filter(
+            models.Session.user_id == 5, models.Session.valid_until > now
+        ),
+        "user by username": select(models.User).filter(
+            models.User.username == "user-5"
+        ),
+    }
+
+
+def fill(engine, users: int, chats: int, messages: int):
+    connectors = users * 2
+    contacts = chats * 5
+    start = datetime(2020, 1, 1)
+
+    with engine.begin() as connection:
+        connection.execute(
+            models.User.__table__.insert(),
+            [
+                dict(user_id=i, username=f"user-{i}", is_verified=True)
+                for i in range(users)
+            ],
+        )
+        connection.execute(
+            models.Session.__table__.insert(),
+            [
+                dict(
+                    user_id=i % users,
+                    name="client",
+                    valid_until=start + timedelta(days=i % 700),
+                )
+                for i in range(users * 10)
+            ],
+        )
+        connection.execute(
+            models.Connector.__table__.insert(),
+            [
+                dict(connector_id=i, connector_type="DEMO", user_id=i % users)
+                for i in range(connectors)
+            ],
+        )
+        connection.execute(
+            models.Contact.__table__.insert(),
+            [
+                dict(
+                    contact_id=i,
+                    internal_id=f"c{i}",
+                    connector_id=i % connectors,
+                    name=f"Contact {i}",
+                    is_self=False,
+                )
+                for i in range(contacts)
+            ],
+        )
+        connection.execute(
+            models.Chat.__table__.insert(),
+            [
+                dict(
+                    chat_id=i,
+                    internal_id=f"chat-{i}",
+                    connector_id=i % connectors,
+                    name=f"Chat {i}",
+                )
+                for i in range(chats)
+            ],
+        )
+        connection.execute(
+            models.ContactsChatsRelationship.__table__.insert(),
+            [dict(contact_id=i, chat_id=i % chats) for i in range(contacts)],
+        )
+
+        for offset in range(0, messages, 100000):
+            connection.execute(
+                models.Message.__table__.insert(),
+                [
+                    dict(
+                        message_id=i,
+                        internal_id=f"m{i}",
+                        contact_id=random.randrange(contacts),
+                        chat_id=random.randrange(chats),
+                        message='{"type": "text", "content": "hello"}',
+                        sent_datetime=start + timedelta(seconds=i),
+                    )
+                    for i in range(offset, min(offset + 100000, messages))
+                ],
+            )
+
+
+def run(engine, repeat: int):
+    for name, statement in queries().items():
+        sql = str(statement.compile(engine, compile_kwargs={"literal_binds": True}))
+
+        with engine.connect() as connection:
+            plan = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+
+            started = time.perf_counter()
+
+            for _ in range(repeat):
+                connection.exec_driver_sql(sql).fetchall()
+
+            elapsed = (time.perf_counter() - started) / repeat
+
+        print(f"{name}: {elapsed * 1000:.3f} ms")
+
+        for row in plan:
+            print(f"    {row[-1]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--chats", type=int, default=20000)
+    parser.add_argument("--messages", type=int, default=500000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    url = f"sqlite:///{os.path.join(directory, 'benchmark.db')}"
+
+    config = Config(os.path.join(ROOT, "alembic.ini"))
+    config.set_main_option("script_location", os.path.join(ROOT, "migrations"))
+    config.set_main_option("sqlalchemy.url", url)
+
+    engine = create_engine(url)
+
+    command.upgrade(config, INITIAL_REVISION)
+    fill(engine, args.users, args.chats, args.messages)
+
+    print("\n# Without indexes\n")
+    run(engine, args.repeat)
+
+    command.upgrade(config, INDEXES_REVISION)
+
+    print("\n# With indexes\n")
+    run(engine, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
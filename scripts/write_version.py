@@ -0,0 +1,23 @@
+"""Write the version of the server to app/VERSION, so it is not resolved with git
+when the server starts.
+
+    python scripts/write_version.py
+"""
+import os
+
+from setuptools_scm import get_version
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    version = get_version(root=ROOT)
+
+    with open(os.path.join(ROOT, "app", "VERSION"), "w") as file:
+        file.write(f"{version}\n")
+
+    print(version)
+
+
+if __name__ == "__main__":
+    main()
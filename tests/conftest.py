@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# The app connects to its database when it is imported, so the tests get their own
+os.environ.setdefault("MOCA_DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/moca.db")
@@ -0,0 +1,81 @@
+import os
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine
+
+from app import crud
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def alembic_config(url: str) -> Config:
+    config = Config(os.path.join(ROOT, "alembic.ini"))
+    config.set_main_option("script_location", os.path.join(ROOT, "migrations"))
+    config.set_main_option("sqlalchemy.url", url)
+    return config
+
+
+def test_stable_ids_keep_every_row(tmp_path):
+    """Rows without an internal id (as created by the debug seed) and rows that
+    were stored more than once must all survive the id migration."""
+
+    url = f"sqlite:///{tmp_path}/moca.db"
+    command.upgrade(alembic_config(url), "a4e7c2b9d815")
+    engine = create_engine(url)
+
+    with engine.begin() as connection:
+        execute = connection.exec_driver_sql
+        execute("INSERT INTO users (user_id, username, is_verified) VALUES (1, 'u', 1)")
+        execute(
+            "INSERT INTO connectors (connector_id, connector_type, user_id, is_finished)"
+            " VALUES (4, 'DEMO', 1, 1)"
+        )
+        # 1 and 2 have no internal id, 3 and 4 are the same contact
+        execute(
+            "INSERT INTO contacts (contact_id, internal_id, connector_id, name, is_self)"
+            " VALUES (1, NULL, 4, 'A', 1), (2, NULL, 4, 'B', 0),"
+            " (3, 'c', 4, 'C', 0), (4, 'c', 4, 'C', 0)"
+        )
+        execute(
+            "INSERT INTO chats (chat_id, internal_id, connector_id, user_id, name)"
+            " VALUES (10, NULL, 4, 1, 'Chat')"
+        )
+        execute(
+            "INSERT INTO contacts_chats_relationship (contact_id, chat_id)"
+            " VALUES (1, 10), (2, 10)"
+        )
+        execute(
+            "INSERT INTO messages (message_id, internal_id, contact_id, chat_id,"
+            " message, sent_datetime) VALUES"
+            " (101, NULL, 1, 10, '{}', '2021-01-01 10:00:00'),"
+            " (102, NULL, 2, 10, '{}', '2021-01-01 10:01:00'),"
+            " (103, NULL, 1, 10, '{}', '2021-01-01 10:02:00'),"
+            " (104, 'm', 3, 10, '{}', '2021-01-01 10:03:00'),"
+            " (105, 'm', 4, 10, '{}', '2021-01-01 10:04:00')"
+        )
+        execute("UPDATE chats SET last_message_id = 105")
+
+    command.upgrade(alembic_config(url), "head")
+
+    with engine.connect() as connection:
+        execute = connection.exec_driver_sql
+        contacts = dict(execute("SELECT contact_id, name FROM contacts").fetchall())
+        messages = dict(
+            execute("SELECT message_id, contact_id FROM messages").fetchall()
+        )
+        participants = execute(
+            "SELECT contact_id, chat_id FROM contacts_chats_relationship"
+        ).fetchall()
+        last_message_id = execute("SELECT last_message_id FROM chats").scalar()
+
+    assert len(contacts) == 4
+    assert contacts[1] == "A" and contacts[2] == "B"
+    assert contacts[crud.get_id(4, "c")] == "C"
+
+    assert len(messages) == 5
+    assert messages[101] == 1 and messages[102] == 2 and messages[103] == 1
+    assert messages[crud.get_message_id(4, "m", 10)] == crud.get_id(4, "c")
+    assert last_message_id in messages
+
+    assert sorted(participants) == [(1, 10), (2, 10)]
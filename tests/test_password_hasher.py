@@ -0,0 +1,44 @@
+import asyncio
+import threading
+
+import pytest
+from passlib.context import CryptContext
+
+from app.password_hasher import PasswordHasher
+
+
+def test_operations_are_counted_when_their_thread_finishes():
+    hasher = PasswordHasher(CryptContext(schemes=["plaintext"]), workers=1)
+    release = threading.Event()
+
+    def fail():
+        raise ValueError("malformed hash")
+
+    async def main():
+        blocked = asyncio.ensure_future(hasher._run(release.wait))
+        await asyncio.sleep(0.05)
+
+        # The thread keeps running when the caller stops waiting
+        blocked.cancel()
+        await asyncio.sleep(0.05)
+        assert hasher.stats()["running"] == 1
+
+        release.set()
+        await asyncio.sleep(0.05)
+
+        with pytest.raises(ValueError):
+            await hasher._run(fail)
+
+        assert await hasher.verify("password", "password")
+        await asyncio.sleep(0.05)
+
+    try:
+        asyncio.run(main())
+    finally:
+        release.set()
+        hasher.shutdown()
+
+    stats = hasher.stats()
+    assert stats["running"] == 0 and stats["queued"] == 0
+    assert stats["completed"] == 2
+    assert stats["failed"] == 1
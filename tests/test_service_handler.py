@@ -0,0 +1,118 @@
+import asyncio
+
+from sqlalchemy import select
+
+from app import crud, models
+from app.database import Base, SessionLocal
+from app.events import messages_event
+from app.service_handler import ServiceHandler
+
+
+class RecordingEvents:
+    def __init__(self):
+        self.events = []
+
+    async def publish(self, user_id, event):
+        self.events.append((user_id, event))
+
+
+def add_connector(connector_id: int):
+    """A user with one connector, which knows the contact "a"."""
+
+    Base.metadata.create_all()
+
+    with SessionLocal() as db:
+        db.add(
+            models.User(
+                user_id=connector_id, username=f"u{connector_id}", is_verified=True
+            )
+        )
+        db.add(
+            models.Connector(
+                connector_id=connector_id,
+                connector_type="telegram",
+                user_id=connector_id,
+                is_finished=True,
+            )
+        )
+        db.add(
+            models.Contact(
+                contact_id=crud.get_id(connector_id, "a"),
+                internal_id="a",
+                connector_id=connector_id,
+                name="A",
+            )
+        )
+        db.commit()
+
+
+def test_messages_without_sender_are_skipped():
+    """A message without a contact_id must not abort the rest of its batch."""
+
+    add_connector(8)
+
+    handler = ServiceHandler(pool=None, events=RecordingEvents())
+    message = {"type": "text", "content": "hello"}
+    payload = [
+        {
+            "message_id": "1",
+            "chat_id": "c",
+            "message": message,
+            "sent_datetime": "2021-01-01T10:00:00Z",
+        },
+        {
+            "message_id": "2",
+            "contact_id": "a",
+            "chat_id": "c",
+            "message": message,
+            "sent_datetime": "2021-01-01T10:01:00Z",
+        },
+    ]
+
+    asyncio.run(handler.handle("moca/via/telegram/8/messages", payload))
+
+    with SessionLocal() as db:
+        rows = db.execute(
+            select(models.Message.internal_id, models.Message.contact_id)
+        ).all()
+
+    chat_id = crud.get_id(8, "c")
+    message_id = crud.get_message_id(8, "2", chat_id)
+
+    assert rows == [("2", crud.get_id(8, "a"))]
+    assert (8, messages_event(chat_id, [message_id])) in handler.events.events
+
+
+def test_chats_keep_their_last_message():
+    add_connector(9)
+
+    handler = ServiceHandler(pool=None, events=RecordingEvents())
+    last_message = {
+        "message_id": "1",
+        "contact_id": "a",
+        "message": {"type": "text", "content": "hello"},
+        "sent_datetime": "2021-01-01T10:00:00Z",
+    }
+    payload = [
+        {"chat_id": "c", "name": "C", "last_message": last_message},
+        {"chat_id": "d", "name": "D", "last_message": {"message_id": "2"}},
+    ]
+
+    asyncio.run(handler.handle("moca/via/telegram/9/chats", payload))
+
+    chat_id = crud.get_id(9, "c")
+    message_id = crud.get_message_id(9, "1", chat_id)
+
+    with SessionLocal() as db:
+        chats = dict(
+            db.execute(
+                select(models.Chat.name, models.Chat.last_message_id).filter(
+                    models.Chat.connector_id == 9
+                )
+            ).all()
+        )
+        message = db.get(models.Message, message_id)
+
+    assert chats == {"C": message_id, "D": None}
+    assert message.contact_id == crud.get_id(9, "a")
+    assert (9, messages_event(chat_id, [message_id])) in handler.events.events